@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Runs the same traces against heap.c, nomalloc.c and the C library's malloc
+
+Build the benchmark binaries first with "make bench".  Each trace is a
+string of tester commands (usually a generated workload) and is run once per
+allocator inside a bench block, followed by memstats and (for heap.c, which
+is the only one whose blocks we can look at) fragreport.  The results are
+printed as a table, or as JSON with --json.
+
+Examples:
+  python3 bench.py
+  python3 bench.py --repeat=5 "workload lifo 200000 200 512 1"
+  python3 bench.py --script=trace.txt --json
+"""
+
+import sys
+import json
+
+from test_common import run_ex, parse_records
+
+
+ALLOCATORS = [
+  # (name, program, can look at blocks)
+  ("heap.c", "./bench-heap", True),
+  ("nomalloc.c", "./bench-nomalloc", False),
+  ("glibc", "./bench-glibc", False),
+]
+
+DEFAULT_TRACES = [
+  "workload churn 200000 200 512 1",
+  "workload powerlaw 200000 200 1024 2",
+  "workload lifo 200000 200 512 3",
+  "workload fifo 200000 200 512 4",
+  "workload prodcons 200000 200 512 5",
+  "workload realloc 200000 200 1024 6",
+]
+
+
+def run_one (prog, trace, repeat=1, blocks=True, timeout=None):
+  """
+  Runs trace under prog, returning a dict of results
+
+  The dict has "rc", "ops_per_sec" (counting only time spent in the
+  allocator), the "bench" records by op, and the "mem" and (if blocks)
+  "frag" records.  If the run fails, "error" has the last line of output.
+  """
+  script = ["checks 0", f"bench {repeat}", trace, "end", "memstats"]
+  if blocks: script.append("fragreport")
+  rc,_,err = run_ex(prog, "\n".join(script) + "\n", "script", "-",
+                    timeout=timeout)
+  r = dict(rc=rc)
+  bench = {b['op']:b for b in parse_records(err, "bench")}
+  mem = parse_records(err, "mem")
+  frag = parse_records(err, "frag")
+  if rc != 0 or not bench or not mem:
+    r['error'] = err.strip().split("\n")[-1]
+    if rc < 0: r['error'] = f"killed by signal {-rc}"
+    return r
+  calls = [b for op,b in bench.items() if op != "all"]
+  count = sum(b['count'] for b in calls)
+  total_ns = sum(b['total_ns'] for b in calls)
+  r['ops_per_sec'] = count * 10**9 // total_ns if total_ns else 0
+  r['bench'] = bench
+  r['mem'] = mem[-1]
+  if frag: r['frag'] = frag[-1]
+  return r
+
+
+def compare (traces, repeat=1, allocators=ALLOCATORS, timeout=None):
+  """
+  Runs each trace against each allocator
+
+  Returns a list of (trace, allocator name, result dict from run_one()).
+  """
+  results = []
+  for trace in traces:
+    for name,prog,blocks in allocators:
+      r = run_one(prog, trace, repeat=repeat, blocks=blocks, timeout=timeout)
+      results.append((trace, name, r))
+  return results
+
+
+def table (results):
+  """
+  Formats compare() results as a text table
+  """
+  head = ["trace", "allocator", "ops/sec", "p99 malloc ns", "peak brk KB",
+          "max RSS KB", "ext frag"]
+  rows = []
+  for trace,name,r in results:
+    if 'error' in r:
+      rows.append([trace, name, "failed: " + r['error']])
+      continue
+    frag = r.get('frag')
+    rows.append([trace, name, str(r['ops_per_sec']),
+                 str(r['bench']['malloc']['p99_ns']),
+                 str(r['mem']['peak_brk'] // 1024),
+                 str(r['mem']['maxrss_kb']),
+                 "%.3f" % (frag['ext_frag_ppm'] / 1e6) if frag else "n/a"])
+  # Failed rows just run off the end, so leave them out of the widths
+  widths = [max(len(x) for x in col)
+            for col in zip(head, *[r for r in rows if len(r) == len(head)])]
+  out = []
+  for row in [head] + rows:
+    out.append("  ".join(x.ljust(w) for x,w in zip(row, widths)).rstrip())
+    if row is head: out.append("  ".join("-" * w for w in widths))
+  return "\n".join(out)
+
+
+def main ():
+  traces = []
+  repeat = 1
+  as_json = False
+  for arg in sys.argv[1:]:
+    if arg.startswith("--repeat="):
+      repeat = int(arg.split("=", 1)[1])
+    elif arg.startswith("--script="):
+      traces.append("script " + arg.split("=", 1)[1])
+    elif arg == "--json":
+      as_json = True
+    elif arg.startswith("--"):
+      print(__doc__.strip())
+      sys.exit(1)
+    else:
+      traces.append(arg)
+  if not traces: traces = DEFAULT_TRACES
+
+  results = compare(traces, repeat=repeat)
+  if as_json:
+    print(json.dumps([dict(trace=t, allocator=n, **r) for t,n,r in results],
+                     indent=2))
+  else:
+    print(table(results))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Fuzzes heap.c through tester on every core, for as long as you like
+
+Each execution runs a random trace of mallocs, reallocs and frees through
+tester (with "script -"), checking the sentinel and every block's contents
+at the end.  Traces are either new (from stress.generate_events(), with
+sizes biased towards the ones where try_split() and friends change their
+minds) or mutations of one in the corpus.  A trace which leaves the heap in
+a new shape (by its fragreport figures) is added to the corpus.  Failures
+are told apart by where they happened -- the function, file and line of a
+failed ASSERT, or else the kind of crash -- and the first trace for each is
+kept.
+
+Everything is kept in the corpus directory (new traces in it, failures in
+its crashes subdirectory), so a campaign can be stopped and picked up again
+later.  Runs until --time seconds or --execs executions have gone by, or
+until interrupted, printing executions/sec and what it has found every
+--report seconds.  Failing traces can be cut down with stress.shrink().
+
+Examples:
+  python3 fuzz.py --time=3600
+  python3 fuzz.py --jobs=4 --corpus=/tmp/corpus --execs=100000
+"""
+
+import sys
+import os
+import re
+import time
+import random
+import hashlib
+import collections
+import multiprocessing
+
+from test_common import run_ex, parse_records
+from stress import generate_events, failure
+
+
+# Sizes on either side of header and split threshold sizes for both builds
+INTERESTING_SIZES = [0, 1, 7, 8, 9, 15, 16, 17, 23, 24, 25, 31, 32, 33, 39,
+                     40, 41, 47, 48, 49, 56, 64, 128, 256]
+
+MAX_EVENTS = 5000 # Mutations don't grow traces past this
+
+
+def _size (rng, maxsize):
+  if rng.random() < 0.5: return rng.choice(INTERESTING_SIZES)
+  return rng.randint(0, maxsize)
+
+
+def fresh (rng):
+  """
+  A new random trace (a list of tester commands)
+  """
+  maxsize = rng.choice([64, 256, 1024, 8192])
+  reallocs = rng.choice([0, 0, 1, 3, 8])
+  return list(generate_events(rng.randint(1, 500),
+                              lambda b, n: max(_size(rng, maxsize), min(n, 1)),
+                              lambda b: rng.randint(0, reallocs),
+                              seed=rng.random(),
+                              max_live=rng.choice([2, 8, 32, 256])))
+
+
+def mutate (events, rng):
+  """
+  A changed copy of a trace
+  """
+  events = list(events)
+  for _ in range(rng.randint(1, 4)):
+    i = rng.randrange(len(events) + 1)
+    j = min(len(events), i + rng.randint(1, 64))
+    kind = rng.randrange(4)
+    if kind == 0:
+      del events[i:j] # Leave some out
+    elif kind == 1:
+      events[i:i] = events[rng.randrange(len(events) + 1):][:j-i] # Repeat some
+    elif kind == 2:
+      for k in range(i, j): # Change sizes
+        w = events[k].split()
+        if len(w) != 3: continue
+        size = _size(rng, 1024)
+        if w[0] == "realloc": size = max(size, 1)
+        events[k] = f"{w[0]} {w[1]} {size}"
+    else:
+      events[i:i] = fresh(rng)[:j-i] # Splice in new ones
+  return events[:MAX_EVENTS] or fresh(rng)
+
+
+def _bucket (n):
+  return n.bit_length()
+
+
+def execute (task):
+  """
+  Runs one trace (in a pool process), returning (events, failure or None,
+  features)
+
+  task is (prog, seed, timeout, trace to mutate or None).  The features
+  are bucketed fragreport figures, for telling whether the heap ended up in
+  a shape that hasn't been seen before.
+  """
+  prog,seed,timeout,base = task
+  rng = random.Random(seed)
+  events = mutate(base, rng) if base else fresh(rng)
+  script = "\n".join(["rel 1", *events, "checksentinel", "fragreport",
+                      "freeall", "checksentinel"]) + "\n"
+  try:
+    rc,_,err = run_ex(prog, script, "script", "-", timeout=timeout)
+  except Exception as e: # Mostly timeouts
+    return events,type(e).__name__,()
+  why = failure(rc, err)
+  frag = parse_records(err, "frag")
+  features = ()
+  if frag:
+    f = frag[-1]
+    features = (_bucket(f['used_blocks']), _bucket(f['free_blocks']),
+                _bucket(f['largest_free']), _bucket(f['brk_size']),
+                _bucket(f['ext_frag_ppm'] // 10000))
+  return events,why,features
+
+
+def _name (events):
+  return hashlib.sha1("\n".join(events).encode("utf8")).hexdigest()[:16]
+
+
+def _site_name (why):
+  """
+  A file name for a failure, e.g. "xfree-heap.c-281"
+  """
+  m = re.match(r'\*\* ASSERTION FAILED in (\S+)\(\) at "?([^":]+)"?:(\d+)', why)
+  if m: return "-".join(m.groups())
+  return re.sub(r"[^A-Za-z0-9.]+", "_", why).strip("_")[:64]
+
+
+class Campaign (object):
+  """
+  The corpus and failures found so far, kept in a directory
+  """
+  def __init__ (self, path="fuzz_corpus"):
+    self.path = path
+    self.crash_path = os.path.join(path, "crashes")
+    os.makedirs(self.crash_path, exist_ok=True)
+    self.corpus = []
+    self.seen = set() # Features of corpus traces
+    self.failures = {} # _site_name() of a failure -> the failure
+    for fn in sorted(os.listdir(path)):
+      if fn.endswith(".txt"):
+        with open(os.path.join(path, fn)) as f:
+          events = f.read().split("\n")
+        if events[0].startswith("# features "):
+          self.seen.add(tuple(int(x) for x in events[0].split()[2:]))
+          events = events[1:]
+        self.corpus.append(events)
+    for fn in sorted(os.listdir(self.crash_path)):
+      if fn.endswith(".txt"):
+        with open(os.path.join(self.crash_path, fn)) as f:
+          self.failures[fn[:-4]] = f.readline()[2:].strip()
+    self.execs = 0
+
+  def _save (self, path, events, comment=None):
+    with open(path, "w") as f:
+      if comment: f.write(f"# {comment}\n")
+      f.write("\n".join(events))
+
+  def crash_file (self, site):
+    return os.path.join(self.crash_path, site + ".txt")
+
+  def add (self, events, why, features):
+    """
+    Notes the result of an execution, returning True if it was new
+
+    Failures are told apart by _site_name(), which is also the name of the
+    file their trace is kept in.  Corpus traces are kept with their
+    features in a comment on the first line, so that a campaign which is
+    picked up again knows which heap shapes it has already seen.
+    """
+    self.execs += 1
+    if why:
+      site = _site_name(why)
+      if site in self.failures: return False
+      self.failures[site] = why
+      self._save(self.crash_file(site),
+                 ["rel 1"] + events + ["checksentinel", "freeall",
+                                       "checksentinel"], why)
+      return True
+    if not features or features in self.seen: return False
+    self.seen.add(features)
+    self.corpus.append(events)
+    self._save(os.path.join(self.path, _name(events) + ".txt"), events,
+               "features " + " ".join(str(x) for x in features))
+    return True
+
+  def tasks (self, prog, timeout, rng):
+    """
+    Endless tasks for execute(): mostly mutations once there's a corpus
+    """
+    while True:
+      base = None
+      if self.corpus and rng.random() < 0.8: base = rng.choice(self.corpus)
+      yield prog,rng.getrandbits(64),timeout,base
+
+  def report (self, start):
+    t = time.time() - start
+    print(f"execs={self.execs} execs_per_sec={self.execs / t if t else 0:.1f}"
+          f" corpus={len(self.corpus)} failures={len(self.failures)}",
+          flush=True)
+
+
+def main ():
+  opts = dict(jobs=os.cpu_count() or 1, time=None, execs=None, report=10,
+              timeout=10, seed=None, corpus="fuzz_corpus", prog="./tester")
+  for arg in sys.argv[1:]:
+    name,_,value = arg[2:].partition("=")
+    if arg.startswith("--") and name in opts and value:
+      opts[name] = value if name in ("corpus", "prog") else int(value)
+    else:
+      print(__doc__.strip())
+      sys.exit(1)
+
+  c = Campaign(opts['corpus'])
+  known = len(c.failures)
+  rng = random.Random(opts['seed'])
+  start = last = time.time()
+  tasks = c.tasks(os.path.abspath(opts['prog']), opts['timeout'], rng)
+  with multiprocessing.Pool(opts['jobs']) as pool:
+    # Only a few tasks are handed out ahead, so new corpus entries get used
+    pending = collections.deque()
+    try:
+      while True:
+        while len(pending) < 2 * opts['jobs']:
+          pending.append(pool.apply_async(execute, (next(tasks),)))
+        events,why,features = pending.popleft().get()
+        if c.add(events, why, features) and why:
+          print("new failure:", why, flush=True)
+        now = time.time()
+        if now - last >= opts['report']:
+          c.report(start)
+          last = now
+        if opts['time'] and now - start >= opts['time']: break
+        if opts['execs'] and c.execs >= opts['execs']: break
+    except KeyboardInterrupt:
+      pass
+  c.report(start)
+  for site,why in sorted(c.failures.items()):
+    print(f"{c.crash_file(site)}: {why}")
+  sys.exit(1 if len(c.failures) > known else 0)
+
+
+if __name__ == "__main__":
+  main()
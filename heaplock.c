@@ -0,0 +1,106 @@
+/*
+ * Wraps heap.c in a single global lock so that it can be used from several
+ * threads at once (see tester's threads command).  This is for the tester-mt
+ * build in the Makefile, which compiles heap.c with its functions renamed to
+ * heap_malloc() and so on, and this file provides them under the usual names.
+ *
+ * Each thread also keeps count of how many times it had to wait for the lock
+ * and for how long, so contention can be measured.  Getting the lock without
+ * waiting doesn't look at the clock at all.
+ */
+
+#include <stdlib.h>
+#include <stdint.h>
+#include <time.h>
+#include <pthread.h>
+
+#include "util.h"
+
+#ifndef MALLOC
+  #define MALLOC malloc
+#endif
+#ifndef FREE
+  #define FREE free
+#endif
+#ifndef REALLOC
+  #define REALLOC realloc
+#endif
+#ifndef CALLOC
+  #define CALLOC calloc
+#endif
+#ifndef REALLOCARRAY
+  #define REALLOCARRAY reallocarray
+#endif
+
+// heap.c's functions, as renamed by the Makefile
+void * heap_malloc (size_t sz);
+void heap_free (void * ptr);
+void * heap_realloc (void * ptr, size_t sz);
+void * heap_calloc (size_t nmemb, size_t size);
+void * heap_reallocarray (void * ptr, size_t nmemb, size_t size);
+
+static pthread_mutex_t heap_lock = PTHREAD_MUTEX_INITIALIZER;
+
+__thread uint64_t heap_lock_wait_ns;
+__thread uint64_t heap_lock_waits;
+
+static uint64_t now_ns ()
+{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec * 1000000000u + ts.tv_nsec;
+}
+
+static void lock ()
+{
+  if (pthread_mutex_trylock(&heap_lock) == 0) return;
+  uint64_t start = now_ns();
+  pthread_mutex_lock(&heap_lock);
+  heap_lock_wait_ns += now_ns() - start;
+  heap_lock_waits++;
+}
+
+static void unlock ()
+{
+  pthread_mutex_unlock(&heap_lock);
+}
+
+
+void * MALLOC (size_t sz)
+{
+  lock();
+  void * r = heap_malloc(sz);
+  unlock();
+  return r;
+}
+
+void FREE (void * ptr)
+{
+  lock();
+  heap_free(ptr);
+  unlock();
+}
+
+void * REALLOC (void * ptr, size_t sz)
+{
+  lock();
+  void * r = heap_realloc(ptr, sz);
+  unlock();
+  return r;
+}
+
+void * CALLOC (size_t nmemb, size_t size)
+{
+  lock();
+  void * r = heap_calloc(nmemb, size);
+  unlock();
+  return r;
+}
+
+void * REALLOCARRAY (void * ptr, size_t nmemb, size_t size)
+{
+  lock();
+  void * r = heap_reallocarray(ptr, nmemb, size);
+  unlock();
+  return r;
+}
@@ -0,0 +1,64 @@
+/*
+ * A program break of our own, for the libheap.so build of heap.c, which is
+ * loaded into some other program (like Python, for heapview.py).  That
+ * program's own malloc() may be using the real program break, so heap.c is
+ * compiled with sbrk() renamed to heap_sbrk(), which moves a break around
+ * inside one big mmap()ed region instead.
+ *
+ * heap_reset() moves the break back to the start of the region and forgets
+ * heap.c's blocks, so that the next thing run gets a fresh heap.
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+#include <errno.h>
+#include <unistd.h>
+#include <sys/mman.h>
+
+#ifndef HEAP_REGION
+  #define HEAP_REGION (256 * 1024 * 1024) // Most the break can grow
+#endif
+
+typedef struct
+{
+  size_t size;
+  int is_used;
+} Block;
+
+extern Block * first_block;
+
+static char * region = NULL;
+static size_t brk_offset = 0;
+
+static int map_region ()
+{
+  if (region) return 1;
+  void * r = mmap(NULL, HEAP_REGION, PROT_READ | PROT_WRITE,
+                  MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+  if (r == MAP_FAILED) return 0;
+  region = r;
+  return 1;
+}
+
+void * heap_sbrk (intptr_t increment)
+{
+  // Works like sbrk(), including failing with ENOMEM
+  if (!map_region()
+      || (increment < 0 && (size_t)-increment > brk_offset)
+      || (increment > 0 && (size_t)increment > HEAP_REGION - brk_offset))
+  {
+    errno = ENOMEM;
+    return (void *)-1;
+  }
+  char * old = region + brk_offset;
+  brk_offset += increment;
+  return old;
+}
+
+void heap_reset ()
+{
+  // Throw away the pages that were used, so a fresh heap is zeroed again
+  if (region && brk_offset) madvise(region, brk_offset, MADV_DONTNEED);
+  brk_offset = 0;
+  first_block = NULL;
+}
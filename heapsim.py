@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""
+A model of heap.c's block layout, for what-ifs and for checking heap.c
+
+HeapSim follows what heap.c's MALLOC(), FREE() and REALLOC() do to the
+blocks -- first fit, try_split()'s threshold, try_merge(), try_merge_all()
+and try_release_memory() -- and where the program break ends up, without
+running any C or keeping any data.  The blocks are kept in NumPy arrays of
+offsets, sizes and states (HeapDump's states) with gaps between them, so
+splitting and merging blocks don't move the others.  The first fit search
+is a single pass over the arrays in NumPy, and everything else a call does
+is a fixed amount of work.  Calls still go one at a time, since each
+depends on the heap the last one left, so replaying a trace is a Python
+loop over its records.  Offsets are from first_block, as with tester's
+"rel 1".  By default it models the 32 bit tester build.
+
+It can run tester commands (the ones which change or show the heap; enough
+for test_heap.py's scenarios) and traces made by tester's record command.
+Needs NumPy.
+
+Examples:
+  python3 heapsim.py "rel 1 -- malloc 0..3 8 -- free 1 -- showheap"
+  python3 heapsim.py --replay=trace.htrc
+  python3 heapsim.py --bits=64 --replay=trace.htrc (from a 64 bit tester)
+"""
+
+import sys
+import re
+import shlex
+
+import numpy as np
+
+from test_common import HeapDump
+
+
+class HeapSimError (Exception):
+  """
+  Something heap.c would have failed an assertion on (or crashed doing)
+  """
+
+
+class HeapSim (object):
+  """
+  heap.c's blocks, in address order
+
+  The arrays have room to spare, with unused entries (gaps) spread between
+  the blocks, so that splitting a block usually just fills the gap after it
+  and merging blocks just leaves gaps behind, rather than moving all the
+  blocks after them.  A gap's offset is the next block's, which keeps the
+  offsets sorted for searching.  When the arrays fill up, the blocks are
+  spread out again into twice the room.
+  """
+  FREE = HeapDump.FREE
+  USED = HeapDump.USED
+  GAP = 0xff # An unused entry
+
+  def __init__ (self, bits=32, align=8, capacity=1024):
+    self.header = 8 if bits == 32 else 16 # sizeof(BlockHeader)
+    self.align = align
+    self.mask = (1 << bits) - 1 # size_t wraps around
+    self.offsets = np.zeros(capacity, np.int64)
+    self.sizes = np.zeros(capacity, np.int64)
+    self.states = np.full(capacity, self.GAP, np.uint8)
+    self.n = 0 # Blocks, including the sentinel (none until the first malloc)
+    self.top = -1 # Index of the sentinel; everything after it is a gap
+    self.peak_brk = 0
+
+  # -------------------------------------------------------------------------
+  #  The blocks
+  # -------------------------------------------------------------------------
+
+  @property
+  def brk (self):
+    """
+    The program break, relative to first_block
+    """
+    if not self.n: return 0
+    return int(self.offsets[self.top]) + self.header
+
+  def _round (self, sz):
+    sz = (sz + self.header) & self.mask
+    return -(-sz // self.align) * self.align
+
+  def _index (self, ptr):
+    """
+    Index of the block whose data is at ptr
+    """
+    off = ptr - self.header
+    offsets = self.offsets[:max(self.top, 0)]
+    i = int(np.searchsorted(offsets, off, "right")) - 1
+    if i < 0 or self.states[i] == self.GAP or self.offsets[i] != off:
+      raise HeapSimError("Not a block: 0x%08x" % ptr)
+    return i
+
+  def _next (self, i):
+    """
+    Index of the block after block i (which isn't the sentinel)
+    """
+    j = i + 1
+    if self.states[j] == self.GAP:
+      j += int(np.argmax(self.states[j:self.top+1] != self.GAP))
+    return j
+
+  def _prev (self, i):
+    """
+    Index of the block before block i, or -1 if it's the first
+    """
+    j = i - 1
+    if j >= 0 and self.states[j] == self.GAP:
+      blocks = np.flatnonzero(self.states[:j] != self.GAP)
+      j = int(blocks[-1]) if len(blocks) else -1
+    return j
+
+  def _spread (self, i):
+    """
+    Moves the blocks into twice the room with a gap after each one,
+    returning block i's new index
+    """
+    blocks = np.flatnonzero(self.states[:self.top+1] != self.GAP)
+    m = len(blocks)
+    cap = max(2 * len(self.states), 2 * m + 2)
+    offsets = np.zeros(cap, np.int64)
+    sizes = np.zeros(cap, np.int64)
+    states = np.full(cap, self.GAP, np.uint8)
+    offsets[0:2*m:2] = self.offsets[blocks]
+    offsets[1:2*m-1:2] = self.offsets[blocks[1:]]
+    sizes[0:2*m:2] = self.sizes[blocks]
+    states[0:2*m:2] = self.states[blocks]
+    self.offsets,self.sizes,self.states = offsets,sizes,states
+    self.top = 2 * (m - 1)
+    return 2 * int(np.searchsorted(blocks, i)) if i >= 0 else -1
+
+  def _insert (self, i, offset, size, state):
+    """
+    Adds a block after block i (or first, if i is -1), moving the blocks up
+    to the next gap along by one, and returns block i's index
+    """
+    if self.top + 1 == len(self.states): i = self._spread(i)
+    g = i + 1 + int(np.argmax(self.states[i+1:self.top+2] == self.GAP))
+    for a,v in ((self.offsets, offset), (self.sizes, size),
+                (self.states, state)):
+      a[i+2:g+1] = a[i+1:g]
+      a[i+1] = v
+    if g == self.top + 1: self.top += 1
+    self.n += 1
+    return i
+
+  def _clear (self, i, j):
+    """
+    Turns everything between blocks i and j into gaps
+    """
+    self.n -= int(np.count_nonzero(self.states[i+1:j] != self.GAP))
+    self.states[i+1:j] = self.GAP
+    self.sizes[i+1:j] = 0
+    self.offsets[i+1:j] = self.offsets[j]
+
+  def _init (self):
+    if self.n: return
+    self._add_sentinel(0)
+
+  def _add_sentinel (self, offset):
+    self._insert(self.top, offset, 0, self.USED)
+    self.peak_brk = max(self.peak_brk, self.brk)
+
+  def _split (self, i, sz):
+    """
+    try_split(), returning block i's index (which may have changed)
+    """
+    size = int(self.sizes[i])
+    if sz >= size: return i
+    leftover = size - sz
+    if leftover < self.header + 24: return i
+    self.sizes[i] = sz
+    return self._insert(i, int(self.offsets[i]) + sz,
+                        -(-leftover // self.align) * self.align, self.FREE)
+
+  def _merge (self, i):
+    """
+    try_merge(): block i takes in the free blocks after it
+    """
+    j = self._next(i)
+    if self.states[j] != self.FREE: return
+    while self.states[j] == self.FREE: # The sentinel is used, so this stops
+      self.sizes[i] += self.sizes[j]
+      j = self._next(j)
+    self._clear(i, j)
+
+  def _merge_all (self, i):
+    """
+    try_merge_all(): every run of free blocks becomes one block
+
+    Between calls there are never two free blocks next to each other, so
+    only the run that block i (the one just freed or split off) is in can
+    need merging.
+    """
+    while self.states[i] == self.FREE:
+      p = self._prev(i)
+      if p < 0 or self.states[p] != self.FREE: break
+      i = p
+    if self.states[i] == self.FREE: self._merge(i)
+
+  def _release (self):
+    """
+    try_release_memory(): a free last block goes back, sentinel and all
+    """
+    if self.n < 2: return
+    top = self.top
+    i = self._prev(top)
+    if self.states[i] != self.FREE: return
+    self.sizes[i] = 0
+    self.states[i] = self.USED
+    self.states[i+1:top+1] = self.GAP
+    self.sizes[i+1:top+1] = 0
+    self.top = i
+    self.n -= 1
+
+  # -------------------------------------------------------------------------
+  #  heap.c's interface
+  # -------------------------------------------------------------------------
+
+  # Pointers are offsets from first_block, and NULL is None.
+
+  def malloc (self, sz):
+    self._init()
+    sz = self._round(sz)
+    top = self.top
+    fit = (self.states[:top] == self.FREE) & (self.sizes[:top] >= sz)
+    i = int(fit.argmax()) if top else 0
+    if top and fit[i]: # The first fit, found in one pass
+      self.states[i] = self.USED
+      i = self._split(i, sz)
+      return int(self.offsets[i]) + self.header
+    # The sentinel becomes the new block
+    ptr = int(self.offsets[top]) + self.header
+    self.sizes[top] = sz
+    self._add_sentinel(int(self.offsets[top]) + sz)
+    return ptr
+
+  def free (self, ptr):
+    if ptr is None: return
+    i = self._index(ptr)
+    if self.states[i] != self.USED:
+      raise HeapSimError("Block isn't in use: 0x%08x" % ptr)
+    self.states[i] = self.FREE
+    self._merge_all(i)
+    self._release()
+
+  def realloc (self, ptr, sz):
+    if ptr is None: return self.malloc(sz)
+    if sz == 0:
+      self.free(ptr)
+      return None
+    sz = self._round(sz)
+    i = self._index(ptr)
+    if sz > self.sizes[i]:
+      self._merge(i)
+      i = self._split(i, sz)
+      if self.sizes[i] >= sz: return ptr
+      new = self.malloc(sz - self.header)
+      self.free(ptr)
+      return new
+    i = self._split(i, sz)
+    self._merge_all(self._next(i))
+    self._release()
+    return ptr
+
+  def calloc (self, nmemb, size):
+    return self.malloc((nmemb * size) & self.mask)
+
+  def reallocarray (self, ptr, nmemb, size):
+    return self.realloc(ptr, (nmemb * size) & self.mask)
+
+  # -------------------------------------------------------------------------
+  #  Looking at it
+  # -------------------------------------------------------------------------
+
+  def blocks (self):
+    """
+    (offset, size, state) for each block, ending with the sentinel
+    """
+    used = np.flatnonzero(self.states[:self.top+1] != self.GAP)
+    states = self.states[used]
+    if len(used): states[-1] = HeapDump.SENTINEL
+    return list(zip(self.offsets[used].tolist(), self.sizes[used].tolist(),
+                    states.tolist()))
+
+  def view (self):
+    """
+    The heap as a HeapDump, as from tester's dumpheap
+    """
+    used = np.flatnonzero(self.states[:self.top+1] != self.GAP)
+    n = len(used)
+    recs = np.zeros((n + 1, 3), np.uint32)
+    recs[0] = np.frombuffer(HeapDump._header.pack(b"HEAP", 1, n), np.uint32)
+    recs[1:,0] = self.offsets[used]
+    recs[1:,1] = self.sizes[used]
+    recs[1:,2] = self.states[used]
+    if n: recs[n,2] = HeapDump.SENTINEL
+    return HeapDump(recs.tobytes())
+
+
+# ---------------------------------------------------------------------------
+#  Running tester commands and traces
+# ---------------------------------------------------------------------------
+
+def _number (word):
+  """
+  A number argument, the way tester's struint32() reads it
+  """
+  named = dict(on=1, off=0, true=1, false=0)
+  if word in named: return named[word]
+  m = re.match(r"\s*([+-]?)(0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*)", word)
+  if not m: return 0
+  digits = m.group(2)
+  if digits[:2] in ("0x", "0X"): n = int(digits, 16)
+  elif digits.startswith("0"): n = int(digits, 8)
+  else: n = int(digits)
+  if m.group(1) == "-": n = -n
+  return n & 0xffffffff
+
+
+def _slots (word):
+  if ".." not in word: return [_number(word)]
+  lo,hi = word.split("..", 1)
+  return range(_number(lo), _number(hi) + 1)
+
+
+class Tester (object):
+  """
+  Runs tester commands against a HeapSim, producing the same output as
+  tester would with "rel 1"
+
+  Only commands which change or show the heap are understood, plus ones
+  which make no difference to the layout (like checks and poke, which are
+  ignored).  Anything else raises ValueError, as does showing addresses
+  without "rel 1" (which would be absolute).
+  """
+  # Number of arguments for commands that don't affect the blocks
+  _ignored = dict(checks=1, checksentinel=0, poke=3, pokes=3, peeks=2,
+                  peek=2, peek32=2, fillslot=3, checkslot=2, slots=1,
+                  alignbrk=0)
+
+  def __init__ (self, sim=None):
+    self.sim = sim or HeapSim()
+    self.slots = {} # slot -> (ptr, size)
+    self.verbose = True
+    self.relative = False
+    self.out = []
+
+  def _addr (self, ptr):
+    if not self.relative or not self.sim.n:
+      raise ValueError("Can't simulate absolute addresses")
+    return "0x%08x" % ((ptr or 0) & 0xffffffff)
+
+  def _malloc (self, slot, sz):
+    self.slots[slot] = (self.sim.malloc(sz), sz)
+
+  def _calloc (self, slot, nmemb, sz):
+    ptr = self.sim.calloc(nmemb, sz)
+    self.slots[slot] = (ptr, (nmemb * sz) & self.sim.mask if ptr else 0)
+
+  def _free (self, slot):
+    ptr,_ = self.slots.pop(slot, (None, 0))
+    self.sim.free(ptr)
+
+  def _realloc (self, slot, sz):
+    ptr,_ = self.slots.get(slot, (None, 0))
+    ptr = self.sim.realloc(ptr, sz)
+    if ptr is None:
+      self.out.append("** realloc() failed.")
+      raise SystemExit(3)
+    self.slots[slot] = (ptr, sz)
+
+  def _killslot (self, slot):
+    self.slots.pop(slot, None)
+
+  def _showheap (self):
+    self._addr(0)
+    if self.verbose: self.out.append("-- heap --")
+    self.out.extend(self.sim.view().text().split("\n"))
+
+  def _showbrk (self):
+    self.out.append("brk: " + self._addr(self.sim.brk))
+
+  def _showslots (self):
+    if self.verbose: self.out.append("-- slots --")
+    for s in sorted(self.slots):
+      ptr,sz = self.slots[s]
+      self.out.append("slot num:0x%08x ptr:%s sz:0x%08x"
+                      % (s, self._addr(ptr), sz))
+
+  def _freeall (self):
+    for s in sorted(self.slots):
+      self.sim.free(self.slots[s][0])
+    self.slots.clear()
+
+  def _mark (self):
+    self.out.append("----")
+
+  def _v (self, on):
+    self.verbose = on != 0
+
+  def _rel (self, on):
+    self.relative = on != 0
+
+  def _parse (self, words):
+    """
+    Turns words into a list of (method, args, ...) and nested repeat lists
+    """
+    slot_cmds = dict(malloc=(self._malloc, 1), realloc=(self._realloc, 1),
+                     calloc=(self._calloc, 2), free=(self._free, 0),
+                     killslot=(self._killslot, 0))
+    other = dict(showheap=(self._showheap, 0), showbrk=(self._showbrk, 0),
+                 showslots=(self._showslots, 0), freeall=(self._freeall, 0),
+                 mark=(self._mark, 0), v=(self._v, 1), rel=(self._rel, 1))
+    stack = [[]]
+    i = 0
+    while i < len(words):
+      w = words[i]
+      i += 1
+      if w == "--": continue
+      if w in ("repeat", "bench"):
+        count = _number(words[i]) if w == "repeat" else 1
+        i += 1
+        stack.append([])
+        stack[-2].append((count, stack[-1]))
+      elif w == "end":
+        if len(stack) == 1: raise ValueError("'end' without a block")
+        stack.pop()
+      elif w in slot_cmds:
+        f,nargs = slot_cmds[w]
+        args = [_number(x) for x in words[i+1:i+1+nargs]]
+        for s in _slots(words[i]):
+          stack[-1].append((f, [s] + args))
+        i += 1 + nargs
+      elif w in other:
+        f,nargs = other[w]
+        stack[-1].append((f, [_number(x) for x in words[i:i+nargs]]))
+        i += nargs
+      elif w in self._ignored:
+        i += self._ignored[w]
+      else:
+        raise ValueError(f"Can't simulate {w!r}")
+    if len(stack) > 1: raise ValueError("Missing 'end' for block.")
+    return stack[0]
+
+  def _run (self, program):
+    for f,args in program:
+      if callable(f): f(*args)
+      else:
+        for _ in range(f): self._run(args)
+
+  def run (self, commands):
+    """
+    Runs commands (a string or list of words, as on tester's command line),
+    returning (return code, output lines)
+
+    Output goes into self.out, so a Tester can be given commands bit by bit.
+    A HeapSimError (where heap.c would fail an assertion) propagates.
+    """
+    if isinstance(commands, str): commands = shlex.split(commands)
+    program = self._parse(commands)
+    try:
+      self._run(program)
+    except SystemExit as e:
+      return e.code,self.out
+    return 0,self.out
+
+
+def read_trace (path):
+  """
+  Reads a trace made by tester's record command into a NumPy record array
+  (with fields ticks, op, slot, size and offset)
+  """
+  data = np.fromfile(path, np.uint8)
+  header = data[:24].view(np.dtype([("magic", "S4"), ("version", "<u4"),
+                                    ("count", "<u8"), ("ticks_per_sec", "<u8")]))
+  if header["magic"][0] != b"HTRC" or header["version"][0] != 1:
+    raise ValueError(f"Not a trace file: {path}")
+  count = int(header["count"][0])
+  return data[24:24 * (count + 1)].view(np.dtype([
+    ("ticks", "<u8"), ("op", "<u4"), ("slot", "<u4"), ("size", "<u4"),
+    ("offset", "<u4")]))
+
+
+NO_OFFSET = 0xffffffff # A trace's offset for NULL
+
+def replay (records, sim=None):
+  """
+  Runs trace records (from read_trace()) through a HeapSim the way tester's
+  replay command does
+
+  Returns (sim, moved), where moved is a boolean array of which calls got a
+  result other than the one recorded.  If the trace came from the same heap
+  code, none should have.
+  """
+  sim = sim or HeapSim()
+  slots = {}
+  moved = np.zeros(len(records), bool)
+  malloc,free,realloc,calloc = sim.malloc,sim.free,sim.realloc,sim.calloc
+  ops = records["op"].tolist()
+  slot_ids = records["slot"].tolist()
+  sizes = records["size"].tolist()
+  offsets = records["offset"].tolist()
+  for i,(op,slot,size,offset) in enumerate(zip(ops, slot_ids, sizes, offsets)):
+    ptr = slots.get(slot)
+    if op == 0:
+      ptr = slots[slot] = malloc(size)
+    elif op == 1:
+      free(ptr)
+      slots.pop(slot, None)
+    elif op == 2:
+      ptr = slots[slot] = realloc(ptr, size)
+    elif op == 3:
+      ptr = slots[slot] = calloc(1, size)
+    else:
+      raise ValueError("Bad trace record")
+    if (NO_OFFSET if ptr is None else ptr) != offset: moved[i] = True
+  return sim,moved
+
+
+def main ():
+  bits = 32
+  trace = None
+  commands = []
+  for arg in sys.argv[1:]:
+    if arg.startswith("--bits="):
+      bits = int(arg.split("=", 1)[1])
+    elif arg.startswith("--replay="):
+      trace = arg.split("=", 1)[1]
+    elif arg.startswith("--"):
+      print(__doc__.strip())
+      sys.exit(1)
+    else:
+      commands.append(arg)
+
+  sim = HeapSim(bits=bits)
+  if trace:
+    sim,moved = replay(read_trace(trace), sim)
+    print(f"replay count={len(moved)} moved={int(moved.sum())}"
+          f" brk={sim.brk} peak_brk={sim.peak_brk}")
+  rc = 0
+  if commands:
+    t = Tester(sim)
+    try:
+      rc,out = t.run(" ".join(commands))
+    except (ValueError, HeapSimError) as e:
+      rc,out = 1,t.out + [str(e)]
+    print("\n".join(out))
+  sys.exit(rc)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Runs heap.c inside Python through ctypes, and looks at its blocks directly
+
+Build the library first with "make libheap.so".  Calls go straight to the
+allocator and the heap is read straight out of memory, with no tester
+process to start and no output to parse, so scenarios can run thousands of
+operations in a millisecond.  view() returns the same HeapDump that
+tester's dumpheap gives, so the two can be compared.
+
+heap.c only has one heap, so there's only one per process too; reset()
+throws it away and starts again.  If heap.c crashes or fails an assertion,
+so does Python.
+
+Example:
+  h = Heap()
+  a = h.malloc(8)
+  b = h.malloc(100)
+  h.free(a)
+  print(h.view().text())
+"""
+
+import os
+import sys
+import ctypes
+import struct
+import array
+
+from test_common import HeapDump
+
+
+class Heap (object):
+  """
+  heap.c, as loaded from libheap.so
+
+  Pointers are plain ints (None for NULL), as ctypes gives them.
+  """
+  # heap.c's BlockHeader, in the native layout
+  _block = struct.Struct("@Ni")
+
+  def __init__ (self, path="./libheap.so"):
+    lib = ctypes.CDLL(os.path.abspath(path))
+    vp,sz = ctypes.c_void_p,ctypes.c_size_t
+    for name,res,args in [("xmalloc", vp, [sz]),
+                          ("xfree", None, [vp]),
+                          ("xrealloc", vp, [vp, sz]),
+                          ("xcalloc", vp, [sz, sz]),
+                          ("xreallocarray", vp, [vp, sz, sz]),
+                          ("heap_sbrk", vp, [ctypes.c_ssize_t]),
+                          ("heap_reset", None, [])]:
+      f = getattr(lib, name)
+      f.restype = res
+      f.argtypes = args
+    self.lib = lib
+    self._first_block = vp.in_dll(lib, "first_block")
+    self.header_size = struct.calcsize("@Ni0N") # Padded, as sizeof() is
+
+  def malloc (self, sz):
+    return self.lib.xmalloc(sz)
+
+  def free (self, ptr):
+    self.lib.xfree(ptr)
+
+  def realloc (self, ptr, sz):
+    return self.lib.xrealloc(ptr, sz)
+
+  def calloc (self, nmemb, size):
+    return self.lib.xcalloc(nmemb, size)
+
+  def reallocarray (self, ptr, nmemb, size):
+    return self.lib.xreallocarray(ptr, nmemb, size)
+
+  def reset (self):
+    """
+    Starts again with an empty heap (any pointers from before are invalid)
+    """
+    self.lib.heap_reset()
+
+  @property
+  def first_block (self):
+    return self._first_block.value
+
+  def brk (self):
+    """
+    The current program break (heap.c's, not the real one)
+    """
+    return self.lib.heap_sbrk(0)
+
+  def blocks (self):
+    """
+    Walks the heap from first_block, returning a list of (offset, size,
+    state) with HeapDump's states, ending with the sentinel
+
+    Unlike tester, this doesn't follow a block past the program break; it
+    is marked BAD and the walk ends there.
+    """
+    first = self.first_block
+    if not first: return []
+    end = self.brk() - first
+    mem = ctypes.string_at(first, end)
+    hdr = self._block
+    out = []
+    off = 0
+    while off + hdr.size <= end:
+      size,used = hdr.unpack_from(mem, off)
+      if size == 0:
+        out.append((off, 0, HeapDump.SENTINEL if used else HeapDump.BAD))
+        return out
+      if off + size > end:
+        break
+      out.append((off, size, HeapDump.USED if used else HeapDump.FREE))
+      off += size
+    out.append((off, 0, HeapDump.BAD))
+    return out
+
+  def view (self):
+    """
+    The heap as a HeapDump (like "dumpheap -" in tester)
+    """
+    recs = array.array("I", HeapDump._header.pack(b"HEAP", 1, 0))
+    for o,sz,st in self.blocks():
+      recs.extend((o, sz, st))
+    recs[2] = (len(recs) - 3) // 3
+    return HeapDump(recs.tobytes())
+
+
+def main ():
+  h = Heap(*sys.argv[1:2])
+  ptrs = [h.malloc(sz) for sz in (8, 100, 24, 500)]
+  h.free(ptrs[1])
+  h.free(ptrs[2])
+  print(h.view().text())
+
+
+if __name__ == "__main__":
+  main()
@@ -1,59 +1,154 @@
 /*
- * This is an unintelligent malloc() implementation which only works with
- * fixed size blocks.  It's really not good, but it's good enough to get
- * various parts of the C standard library (like printf()) to work, since
- * some of them need a working malloc().
+ * This is a simple malloc() implementation for the parts of the C standard
+ * library (like printf()) which need a working malloc(), so that they don't
+ * use the heap we're testing.
  *
+ * Small requests come from a static arena divided into a few power-of-two
+ * size classes (16 bytes up to 2048 by default).  Each class has its own
+ * region of the arena and a bitmap of which of its blocks are in use, and a
+ * free block is found by looking for the first word of the bitmap that isn't
+ * full and taking its lowest clear bit.  If a class is full, the next larger
+ * one is used.  Anything too large (or that doesn't fit) gets its own mmap().
  */
 
 #include <stdlib.h>
 #include <string.h>
 #include <stddef.h>
 #include <stdint.h>
+#include <stdbool.h>
 
 #include <unistd.h>
+#include <sys/mman.h>
 
 #include "util.h"
 
-#ifndef BLOCK_SIZE
-  #define BLOCK_SIZE 2048
+#ifndef MIN_BLOCK_SHIFT
+  #define MIN_BLOCK_SHIFT 4 // Smallest class is 16 bytes
 #endif
-#ifndef BLOCK_COUNT
-  #define BLOCK_COUNT 64
+#ifndef NUM_CLASSES
+  #define NUM_CLASSES 8 // ...and the largest is 2048
 #endif
+#ifndef CLASS_BYTES
+  #define CLASS_BYTES (64 * 1024) // Arena space for each class
+#endif
+
+#define MIN_BLOCK (1 << MIN_BLOCK_SHIFT)
+#define MAX_BLOCK (MIN_BLOCK << (NUM_CLASSES - 1))
+#define MAX_WORDS (CLASS_BYTES / MIN_BLOCK / 32)
+
+_Static_assert(CLASS_BYTES % (MAX_BLOCK * 32) == 0,
+               "Each class needs a whole number of bitmap words");
 
-static char mem[BLOCK_SIZE * BLOCK_COUNT];
-static int used[BLOCK_COUNT];
+// Headers for mmap()ed blocks hold the size of the mapping, and are this big
+// so that the data keeps the same alignment as arena blocks.
+#define BIG_HEADER MIN_BLOCK
+
+static char arena[NUM_CLASSES][CLASS_BYTES] __attribute__((aligned(MIN_BLOCK)));
+static uint32_t used[NUM_CLASSES][MAX_WORDS];
+static int first_free[NUM_CLASSES]; // Words before this one are full
 
 #define DBG(x)
 
-void * malloc (size_t sz)
+static int words_in_class (int c)
 {
-  DBG(print("malloc sz:"); printhex32(sz); print(" "););
-  ASSERT(sz < BLOCK_SIZE);
-  for (int i = 0; i < BLOCK_COUNT; ++i)
+  return (CLASS_BYTES >> (MIN_BLOCK_SHIFT + c)) / 32;
+}
+
+// The smallest class with blocks of at least sz bytes (may be NUM_CLASSES).
+static int class_for (size_t sz)
+{
+  if (sz <= MIN_BLOCK) return 0;
+  return (sizeof(long) * 8 - __builtin_clzl(sz - 1)) - MIN_BLOCK_SHIFT;
+}
+
+static bool in_arena (void * ptr)
+{
+  char * p = ptr;
+  return p >= arena[0] && p < arena[0] + sizeof(arena);
+}
+
+static void * class_alloc (int c)
+{
+  int words = words_in_class(c);
+  for (int w = first_free[c]; w < words; ++w)
   {
-    if (used[i] == 0)
-    {
-      used[i] = 1;
-      DBG(print("blk:");printhex32(i);print(" ptr:");printhex32((intptr_t)(mem + BLOCK_SIZE*i));nl(););
-      return mem + BLOCK_SIZE * i;
-    }
+    if (used[c][w] == 0xffffffffu) continue;
+    int bit = __builtin_ctz(~used[c][w]);
+    used[c][w] |= 1u << bit;
+    first_free[c] = w;
+    return arena[c] + ((size_t)(w * 32 + bit) << (MIN_BLOCK_SHIFT + c));
   }
-  DBG(print("---");nl();)
+  first_free[c] = words;
   return NULL;
 }
 
+static void class_free (void * ptr)
+{
+  size_t off = (char *)ptr - arena[0];
+  int c = off / CLASS_BYTES;
+  off %= CLASS_BYTES;
+  ASSERT((off & ((MIN_BLOCK << c) - 1)) == 0); // Bad ptr
+  size_t i = off >> (MIN_BLOCK_SHIFT + c);
+  uint32_t bit = 1u << (i % 32);
+  ASSERT(used[c][i / 32] & bit); // Not allocated
+  used[c][i / 32] &= ~bit;
+  if (i / 32 < first_free[c]) first_free[c] = i / 32;
+}
+
+static void * big_alloc (size_t sz)
+{
+  size_t page = sysconf(_SC_PAGESIZE);
+  if (sz > SIZE_MAX - BIG_HEADER - page) return NULL;
+  size_t total = (sz + BIG_HEADER + page - 1) / page * page;
+  char * p = mmap(NULL, total, PROT_READ | PROT_WRITE,
+                  MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  if (p == MAP_FAILED) return NULL;
+  *(size_t *)p = total;
+  return p + BIG_HEADER;
+}
+
+// How many bytes the block at ptr can hold.
+static size_t capacity (void * ptr)
+{
+  if (in_arena(ptr))
+  {
+    return MIN_BLOCK << (((char *)ptr - arena[0]) / CLASS_BYTES);
+  }
+  return *(size_t *)((char *)ptr - BIG_HEADER) - BIG_HEADER;
+}
+
+// Does the work for malloc().  It's separate so that calloc() can use it
+// too: if calloc() called malloc() and then memset(), the compiler is
+// allowed to turn that into a call to calloc().
+static void * alloc (size_t sz)
+{
+  for (int c = class_for(sz); c < NUM_CLASSES; ++c)
+  {
+    void * p = class_alloc(c);
+    DBG(print("class:");printhex32(c);print(" ptr:");printhex32((intptr_t)p);nl(););
+    if (p) return p;
+  }
+  DBG(print("big");nl();)
+  return big_alloc(sz);
+}
+
+void * malloc (size_t sz)
+{
+  DBG(print("malloc sz:"); printhex32(sz); print(" "););
+  return alloc(sz);
+}
+
 void free (void * ptr)
 {
   DBG(print("free "); printhex32((intptr_t)ptr); nl(););
   if (!ptr) return;
-  ptrdiff_t off = ((char *)ptr) - mem;
-  ASSERT((off % BLOCK_SIZE) == 0); // Bad ptr
-  off /= BLOCK_SIZE;
-  ASSERT(off < BLOCK_COUNT); // Too large to be valid
-  ASSERT(used[off]); // Not allocated
-  used[off] = 0;
+  if (in_arena(ptr))
+  {
+    class_free(ptr);
+    return;
+  }
+  char * p = (char *)ptr - BIG_HEADER;
+  munmap(p, *(size_t *)p);
 }
 
 void * realloc (void * ptr, size_t sz)
@@ -65,24 +160,31 @@ void * realloc (void * ptr, size_t sz)
   // Special case -- if sz is 0, this is equivalent to free().
   if (sz == 0) { free(ptr); return NULL; }
 
-  if (sz > BLOCK_SIZE) return NULL;
+  // Stay put if it still fits and isn't down to less than half the block
+  // (which would belong in a smaller class).
+  size_t cap = capacity(ptr);
+  if (sz <= cap && (sz > cap / 2 || cap == MIN_BLOCK)) return ptr;
 
-  return ptr;
+  void * r = malloc(sz);
+  if (!r) return NULL;
+  memcpy(r, ptr, sz < cap ? sz : cap);
+  free(ptr);
+  return r;
 }
 
-// Once you implement malloc(), this should just work.
 void * calloc (size_t nmemb, size_t size)
 {
-  // We actually are supposed to check for overflow, but don't.
-  void * ptr = malloc(nmemb * size);
+  size_t sz;
+  if (__builtin_mul_overflow(nmemb, size, &sz)) return NULL;
+  void * ptr = alloc(sz);
   if (!ptr) return NULL;
-  memset(ptr, 0, size);
+  if (in_arena(ptr)) memset(ptr, 0, sz); // mmap() memory is already zeroed
   return ptr;
 }
 
-// Once you implement realloc(), this should just work.
 void * reallocarray (void * ptr, size_t nmemb, size_t size)
 {
-  // We actually are supposed to check for overflow, but don't.
-  return realloc(ptr, nmemb * size);
+  size_t sz;
+  if (__builtin_mul_overflow(nmemb, size, &sz)) return NULL;
+  return realloc(ptr, sz);
 }
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Runs long random traces through tester, and shrinks the ones that fail
+
+generate_events() produces a seeded trace of tester commands one at a time,
+so traces of millions of events take time in proportion to their length and
+never have to be held in memory.  run_trace() feeds one to tester on stdin,
+with a checksentinel after every chunk of events, and frees everything at
+the end (which checks every block's contents).  With --compare, the final
+heap is also checked against heapsim.py's model.  If a trace fails, it's
+generated again and shrunk to a short trace which fails the same way, which
+is written out as a tester script.
+
+Examples:
+  python3 stress.py --blocks=1000000 --seed=3
+  python3 stress.py --blocks=20000 --reallocs=8 --compare --out=fail.txt
+"""
+
+import sys
+import re
+import random
+import itertools
+
+from test_common import run_ex
+
+
+def generate_events (num_blocks, sizes_f=None, num_reallocs_f=None, seed=None,
+                     max_live=256):
+  """
+  Yields a random trace of tester commands
+
+  Each of num_blocks blocks is malloc'd, realloc'd num_reallocs_f(block)
+  times and freed, with sizes from sizes_f(block, alloc_num), and the
+  blocks' events are interleaved at random.  At most max_live blocks are
+  live at once, each in one of slots 0..max_live-1.  The defaults are sizes
+  up to 256 and no reallocs, drawn from the seeded random numbers, so the
+  same seed always gives the same trace.  Realloc sizes should be at least
+  1 (tester treats realloc() returning NULL as a failure).
+  """
+  rng = random.Random(seed)
+  if sizes_f is None: sizes_f = lambda block, n: rng.randint(0, 256)
+  if num_reallocs_f is None: num_reallocs_f = lambda block: 0
+
+  free_slots = list(range(max_live - 1, -1, -1))
+  live = [] # [block, slot, allocations so far, reallocs still to do]
+  next_block = 0
+  while live or next_block < num_blocks:
+    new = len(free_slots) if next_block < num_blocks else 0
+    i = rng.randrange(len(live) + new)
+    if i >= len(live):
+      b = next_block
+      next_block += 1
+      slot = free_slots.pop()
+      live.append([b, slot, 1, num_reallocs_f(b)])
+      yield f"malloc {slot} {sizes_f(b, 0)}"
+      continue
+    e = live[i]
+    if e[3]:
+      yield f"realloc {e[1]} {sizes_f(e[0], e[2])}"
+      e[2] += 1
+      e[3] -= 1
+      continue
+    yield f"free {e[1]}"
+    free_slots.append(e[1])
+    live[i] = live[-1]
+    live.pop()
+
+
+def _chunks (events, chunk):
+  events = iter(events)
+  while True:
+    c = list(itertools.islice(events, chunk))
+    if not c: return
+    yield c
+
+
+def _simulate (events, bits, chunk):
+  """
+  heapsim's showheap output after events, or None if it can't be modelled
+  """
+  import heapsim
+  t = heapsim.Tester(heapsim.HeapSim(bits=bits))
+  try:
+    t.run("rel 1")
+    for c in _chunks(events, chunk): t.run(" ".join(c))
+    t.run("showheap")
+  except (ValueError, heapsim.HeapSimError):
+    return None
+  return "\n".join(t.out)
+
+
+def run_trace (events, prog="./tester", chunk=1000, timeout=None,
+               compare_bits=None):
+  """
+  Runs events through prog, returning (rc, stderr)
+
+  checksentinel is run after every chunk events.  If compare_bits is given,
+  the heap is shown at the end and compared with heapsim's for that many
+  bits (so events must be a list, to go through both), and a difference is
+  added to stderr.
+  """
+  def script ():
+    yield "rel 1\n"
+    for c in _chunks(events, chunk):
+      yield "\n".join(c) + "\nchecksentinel\n"
+    if compare_bits: yield "showheap\n"
+    yield "freeall\nchecksentinel\n"
+  rc,_,err = run_ex(prog, script(), "script", "-", timeout=timeout)
+  if compare_bits and rc == 0:
+    expected = _simulate(events, compare_bits, chunk)
+    if expected is not None and expected.strip() != err.strip():
+      err += "\n** Heap differs from heapsim's"
+  return rc,err
+
+
+def failure (rc, err):
+  """
+  What went wrong with a run (for telling failures apart), or None
+  """
+  m = re.search(r"\*\* ASSERTION FAILED in .* at \S+", err)
+  if m: return m.group(0)
+  if rc < 0: return f"killed by signal {-rc}"
+  for line in err.split("\n"):
+    if line.startswith("** "):
+      return re.sub(r"0x[0-9a-f]+", "0x?", line.split(":")[0])
+  if rc: return f"exit code {rc}"
+  return None
+
+
+def _slot (event):
+  return event.split()[1]
+
+
+def shrink (events, fails, max_runs=2000, key=_slot):
+  """
+  Returns a short sublist of events for which fails() is still true
+
+  Any subsequence of a trace is a valid trace (freeing or reallocing an
+  empty slot just passes NULL), so this first finds the shortest failing
+  prefix, then tries leaving out all the events with the same key (by
+  default, all those for one slot), and then removes ever smaller pieces of
+  what's left (delta debugging) until no single event can go or it has
+  tried max_runs times.
+  """
+  runs = 0
+  lo,hi = 1,len(events)
+  while lo < hi:
+    mid = (lo + hi) // 2
+    runs += 1
+    if fails(events[:mid]): hi = mid
+    else: lo = mid + 1
+  events = events[:hi]
+
+  if key:
+    for k in list(dict.fromkeys(key(e) for e in events)):
+      if runs >= max_runs: break
+      rest = [e for e in events if key(e) != k]
+      runs += 1
+      if rest and fails(rest): events = rest
+
+  n = 2
+  while len(events) >= 2 and runs < max_runs:
+    size = -(-len(events) // n)
+    for start in range(0, len(events), size):
+      rest = events[:start] + events[start+size:]
+      runs += 1
+      if rest and fails(rest):
+        events = rest
+        n = max(n - 1, 2)
+        break
+      if runs >= max_runs: break
+    else:
+      if size == 1: break
+      n = min(n * 2, len(events))
+  return events
+
+
+def main ():
+  opts = dict(blocks=100000, seed=1, reallocs=0, maxsize=256, live=256,
+              chunk=1000, prog="./tester", out=None, bits=32)
+  compare = False
+  for arg in sys.argv[1:]:
+    name,_,value = arg[2:].partition("=")
+    if arg == "--compare":
+      compare = True
+    elif arg.startswith("--") and name in opts and value:
+      opts[name] = value if name in ("prog", "out") else int(value)
+    else:
+      print(__doc__.strip())
+      sys.exit(1)
+
+  def events ():
+    rng = random.Random(opts['seed'] + 1)
+    return generate_events(opts['blocks'],
+      lambda b, n: rng.randint(min(n, 1), opts['maxsize']),
+      lambda b: rng.randint(0, opts['reallocs']),
+      seed=opts['seed'], max_live=opts['live'])
+  bits = opts['bits'] if compare else None
+
+  trace = list(events()) if compare else events()
+  rc,err = run_trace(trace, opts['prog'], opts['chunk'], compare_bits=bits)
+  why = failure(rc, err)
+  if not why:
+    print("ok")
+    return
+
+  print("failed:", why)
+  def fails (evs):
+    rc,err = run_trace(evs, opts['prog'], opts['chunk'], compare_bits=bits)
+    return failure(rc, err) == why
+  small = shrink(list(events()), fails)
+  script = "\n".join(["rel 1"] + small + ["freeall", "checksentinel"]) + "\n"
+  print(f"shrunk to {len(small)} events:")
+  print(script, end="")
+  if opts['out']:
+    with open(opts['out'], "w") as f: f.write(script)
+  sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,11 +1,18 @@
 import unittest
 import subprocess
 import os
-import io
 import shlex
 import inspect
 import sys
 import time
+import tempfile
+import struct
+import concurrent.futures
+import threading
+import hashlib
+import json
+import base64
+import re
 
 
 def _indent (s, spaces = 2, add_newline = False):
@@ -20,32 +27,38 @@ def _indent (s, spaces = 2, add_newline = False):
   return o
 
 
-_fail_cache = {}
+# Test class -> whether all of its tests have passed so far in this run.
+# Filled in as tests run by the suite load_tests() returns.
+_passed = {}
 
 def testFailed (test):
-  cached = _fail_cache.get(test, None)
-  #if cached is not None: print(test, "cached", cached)
-  if cached is not None: return cached
-  #print(test, "not cached")
-
-  out = io.StringIO()
-  tr = unittest.TextTestRunner(stream=out, failfast=True)
-  ts = unittest.defaultTestLoader.loadTestsFromTestCase(test)
-  result = tr.run(ts)
-  #dir(result)
-  def cacheit (v):
-    _fail_cache[test] = v
-    return v
-  if result.errors: return cacheit(True)
-  if result.failures: return cacheit(True)
-  if result.skipped: return cacheit(True)
-  return cacheit(False)
+  """
+  True if a test in class test failed, errored or was skipped in this run
+
+  Only knows about tests that have already run (nothing is run to find out).
+  """
+  return _passed.get(test) is False
 
 def skipIfFailed (*tests):
+  """
+  Class decorator which skips the class's tests if any of tests (which are
+  test classes) didn't pass
+
+  This goes by the results of the tests so far in this run, and load_tests()
+  runs dependencies first.  A dependency which isn't part of the run at all
+  doesn't cause a skip.
+  """
   def f (cls):
-    for test in tests:
-      si = unittest.skipIf(testFailed(test), "Skipped because %s was required to pass" % (test.__name__,))
-    return si(cls)
+    cls._depends_on = getattr(cls, "_depends_on", ()) + tests
+    setUp = cls.setUp
+    def checked_setUp (self):
+      for test in tests:
+        if testFailed(test):
+          self.skipTest("Skipped because %s was required to pass"
+                        % (test.__name__,))
+      setUp(self)
+    cls.setUp = checked_setUp
+    return cls
   return f
 
 
@@ -68,7 +81,7 @@ def set_default_timeout (t):
   _default_timeout = t;
 
 
-def run_ex (cmd, inp, *args, timeout=None):
+def run_ex (cmd, inp, *args, timeout=None, text=True):
   if timeout is None: timeout = _default_timeout
   if args:
     cmd = [cmd] + [str(s) for s in args]
@@ -78,13 +91,75 @@ def run_ex (cmd, inp, *args, timeout=None):
   if inp is None:
     r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                        stdin=subprocess.DEVNULL, timeout=timeout)
-  else:
+  elif isinstance(inp, (str, bytes)):
     if isinstance(inp, str):
       inp = inp.encode("utf8")
     r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                        input=inp, timeout=timeout)
-
-  return r.returncode,r.stdout.decode("utf8").strip(),r.stderr.decode("utf8").strip()
+  else:
+    # A file, or an iterable of str/bytes chunks (e.g., a generator of trace
+    # lines).  Iterables are spooled to a temporary file rather than joined,
+    # so long traces are never held in memory all at once.
+    if hasattr(inp, "fileno"):
+      f = inp
+    else:
+      f = tempfile.TemporaryFile()
+      for chunk in inp:
+        if isinstance(chunk, str): chunk = chunk.encode("utf8")
+        f.write(chunk)
+      f.seek(0)
+    try:
+      r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         stdin=f, timeout=timeout)
+    finally:
+      if f is not inp: f.close()
+
+  out = r.stdout
+  if text: out = out.decode("utf8").strip()
+  return r.returncode,out,r.stderr.decode("utf8").strip()
+
+
+def run_batch (prog, scenarios, timeout=None):
+  """
+  Runs several scenarios in one tester process
+
+  scenarios is a list of argument lists, which are run as "scenario 0
+  <args> scenario 1 <args>...".  tester resets itself at the start of each
+  scenario and marks where each one starts and ends in its output, so this
+  can split the output back up.  A scenario with a bad command gets the
+  return code from its end marker.  A scenario which ends the process (by
+  exiting or crashing) gets its return code, and the scenarios after it are
+  run in a new process, as are any after a scenario that never started.
+  timeout is per scenario.
+
+  Returns a list of (rc, stderr), one for each scenario.  Raises ValueError
+  if the first scenario doesn't even start (e.g., prog doesn't know the
+  scenario command).
+  """
+  results = []
+  while len(results) < len(scenarios):
+    todo = scenarios[len(results):]
+    args = []
+    for i,a in enumerate(todo):
+      args += ["scenario", i] + list(a)
+    t = timeout if timeout is None else timeout * len(todo)
+    rc,_,err = run_ex(prog, None, *args, timeout=t)
+    starts = {}
+    ends = {}
+    for m in re.finditer(r"^== (scenario|end) (\d+)(?: (\d+))?$\n?", err,
+                         re.M):
+      (starts if m.group(1) == "scenario" else ends)[int(m.group(2))] = m
+    if 0 not in starts:
+      raise ValueError(f"{prog} didn't start a scenario")
+    for i in range(len(todo)):
+      if i not in starts: break # Try the rest again on their own
+      stop = ends.get(i) or starts.get(i + 1)
+      out = err[starts[i].end():stop.start() if stop else len(err)].strip()
+      if i not in ends:
+        results.append((rc, out))
+        break
+      results.append((int(ends[i].group(3) or 0), out))
+  return results
 
 
 def lines (s):
@@ -92,10 +167,165 @@ def lines (s):
   return s.split("\n")
 
 
+def _parse_kv (words):
+  r = {}
+  for kv in words:
+    k,v = kv.split("=", 1)
+    try:
+      v = int(v, 0)
+    except ValueError:
+      pass
+    r[k] = v
+  return r
+
+
+def parse_records (s, tag):
+  """
+  Parses "tag key=value key=value ..." lines out of program output
+
+  Returns a list of dicts, one per line starting with tag.  Values which
+  look like integers are converted.
+  """
+  recs = []
+  for l in lines(s):
+    l = l.split()
+    if not l or l[0] != tag: continue
+    recs.append(_parse_kv(l[1:]))
+  return recs
+
+
+def track_fragmentation (prog, trace, every=1000, setup="rel 1", timeout=None):
+  """
+  Runs a trace through tester, taking a fragreport every so often
+
+  trace is an iterable of command lines (e.g., a generator); it's streamed
+  in through script mode, so it needn't fit in memory.  Returns (rc,
+  samples, err), where samples has a dict for each report with the keys
+  from its "frag" line, plus "step" (the number of trace lines before it),
+  "ext_frag" (as a ratio) and "hist" (free block count by minimum size).
+  """
+  steps = []
+  def commands ():
+    yield setup + "\n"
+    n = 0
+    for l in trace:
+      yield l if l.endswith("\n") else l + "\n"
+      n += 1
+      if n % every == 0:
+        steps.append(n)
+        yield "fragreport\n"
+    if not steps or steps[-1] != n:
+      steps.append(n)
+      yield "fragreport\n"
+
+  rc,_,err = run_ex(prog, commands(), "script", "-", timeout=timeout)
+  samples = []
+  for l in lines(err):
+    l = l.split()
+    if not l: continue
+    if l[0] == "frag":
+      r = _parse_kv(l[1:])
+      r['step'] = steps[len(samples)]
+      r['ext_frag'] = r['ext_frag_ppm'] / 1e6
+      r['hist'] = {}
+      samples.append(r)
+    elif l[0] == "fraghist" and samples:
+      r = _parse_kv(l[1:])
+      samples[-1]['hist'][r['min']] = r['count']
+  return rc,samples,err
+
+
+class HeapDump (object):
+  """
+  A heap layout as written by tester's dumpheap command
+
+  The offsets, sizes and states attributes are memoryviews straight into
+  the dump data (no copying or per-block parsing), so large heaps can be
+  compared and summed quickly.  States are FREE, USED, SENTINEL or BAD.
+  """
+  FREE = 0
+  USED = 1
+  SENTINEL = 2
+  BAD = 3
+
+  _state_names = {FREE:"FREE", USED:"USED", SENTINEL:"XXXX", BAD:"????"}
+
+  _header = struct.Struct("=4sII")
+
+  def __init__ (self, data, offset=0):
+    mv = memoryview(data)
+    magic,version,count = self._header.unpack_from(mv, offset)
+    if magic != b"HEAP" or version != 1:
+      raise ValueError("Not a heap dump")
+    start = offset + self._header.size
+    self.nbytes = self._header.size + count * 12
+    recs = mv[start:start + count * 12].cast("I")
+    self.offsets = recs[0::3]
+    self.sizes = recs[1::3]
+    self.states = recs[2::3]
+
+  def __len__ (self):
+    return len(self.states)
+
+  def __eq__ (self, other):
+    if not isinstance(other, HeapDump): return NotImplemented
+    return (self.offsets == other.offsets and self.sizes == other.sizes
+            and self.states == other.states)
+
+  def blocks (self):
+    """
+    Iterates over (offset, size, state) for each block
+    """
+    return zip(self.offsets, self.sizes, self.states)
+
+  def total (self, state):
+    """
+    Sum of the sizes of the blocks with the given state
+    """
+    return sum(sz for sz,st in zip(self.sizes, self.states) if st == state)
+
+  def diff (self, other):
+    """
+    Blocks which differ from other's as (offset, (size, state) or None,
+    other's (size, state) or None), in offset order
+    """
+    mine = {o:(sz,st) for o,sz,st in self.blocks()}
+    theirs = {o:(sz,st) for o,sz,st in other.blocks()}
+    out = []
+    for o in sorted(set(mine) | set(theirs)):
+      a,b = mine.get(o), theirs.get(o)
+      if a != b: out.append((o, a, b))
+    return out
+
+  def text (self):
+    """
+    The same lines showheap prints with relative addresses
+    """
+    return "\n".join("0x%08x 0x%08x %s" % (o, sz, self._state_names[st])
+                     for o,sz,st in self.blocks())
+
+
+def read_heap_dumps (data):
+  """
+  Returns a list of the HeapDumps in data (e.g., several written to stdout)
+  """
+  dumps = []
+  offset = 0
+  while offset < len(data):
+    d = HeapDump(data, offset)
+    dumps.append(d)
+    offset += d.nbytes
+  return dumps
+
+
 def setscore (f, score):
   f.SCORE = score
 
 
+# Valgrind.Case class -> Future for its run; see Valgrind.Case._start()
+_valgrind_runs = {}
+_valgrind_lock = threading.Lock()
+
 class Valgrind (object):
   class Case (unittest.TestCase):
     #NOTE: To disable one of the tests, set it to None in the subclass, e.g.:
@@ -107,25 +337,58 @@ class Valgrind (object):
     stdin_newline = True
     timeout = 5
 
-    def setUp (self):
-      a = self.args
-      if isinstance(self.args, str): self.args = shlex.split(self.args)
-      a = [str(x) for x in self.args]
-      arg = [self.prog] + a
-      if not os.path.isfile(arg[0]): self.skipTest("Program doesn't exist")
-
-      arg = ["--leak-check=full"] + arg
-      stdin = self.stdin
-      if isinstance(stdin, str) and self.stdin_newline:
+    @classmethod
+    def _run_program (cls):
+      """
+      Runs the program under Valgrind, returning (rc, stdout, Valgrind lines)
+      """
+      args = cls.args
+      if isinstance(args, str): args = shlex.split(args)
+      arg = ["--leak-check=full", cls.prog] + [str(x) for x in args]
+      stdin = cls.stdin
+      if isinstance(stdin, str) and cls.stdin_newline:
         if not stdin.endswith("\n"): stdin += "\n"
-      self.rc,self.r,self.v = run_ex("valgrind", stdin, *arg,
-                                     timeout=self.timeout)
+      parts = ("valgrind", tuple(arg), stdin, cls.timeout)
+      rc,r,v = _disk_cached(cls.prog, parts,
+                            lambda: run_ex("valgrind", stdin, *arg,
+                                           timeout=cls.timeout))
+      l = [x[2:] for x in lines(v) if x.startswith("==")]
+      l = [x.split("==",1)[-1] for x in l]
+      return rc,r,l
+
+    @classmethod
+    def _start (cls, pool=None):
+      """
+      Returns a Future for the class's Valgrind run
+
+      Valgrind is slow, so it's only run once per class and the results are
+      shared by all the test methods.  The first call starts it (in pool if
+      given, or else right here).
+      """
+      with _valgrind_lock:
+        f = _valgrind_runs.get(cls)
+        if f is not None: return f
+        f = _valgrind_runs[cls] = concurrent.futures.Future()
+      def run ():
+        try:
+          f.set_result(cls._run_program())
+        except BaseException as e:
+          f.set_exception(e)
+      if pool:
+        pool.submit(run)
+      else:
+        run()
+      return f
+
+    def _prefetch (self, pool):
+      if os.path.isfile(self.prog): self._start(pool)
+
+    def setUp (self):
+      if not os.path.isfile(self.prog): self.skipTest("Program doesn't exist")
+      self.rc,self.r,self.v = self._start().result()
       if self.rc < 0: self.skipTest("Program crashed")
       if self.rc == 127: self.skipTest("Valgrind error?")
       #self.assertEqual(self.rc, 0, "Expected 0 return value")
-      l = [x[2:] for x in lines(self.v) if x.startswith("==")]
-      l = [x.split("==",1)[-1] for x in l]
-      self.v = l
 
     def test_no_definitely_lost (self):
       l = [x for x in self.v if x.strip().startswith("definitely lost: ")]
@@ -173,6 +436,138 @@ class Valgrind (object):
       self.assertEqual(len(l1)+len(l2), 0, "Invalid memory access")
 
 
+# Results of program runs by everything that affects them; see _cached_run()
+_run_cache = {}
+_run_cache_lock = threading.Lock()
+
+def _cached_run (key, fn):
+  """
+  Returns fn()'s result, only calling it the first time for each key
+
+  Callers with the same key at the same time wait for the first one's
+  result.  Exceptions (e.g., timeouts) aren't kept, so a later call tries
+  again.
+  """
+  with _run_cache_lock:
+    f = _run_cache.get(key)
+    mine = f is None
+    if mine: f = _run_cache[key] = concurrent.futures.Future()
+  if mine:
+    try:
+      f.set_result(fn())
+    except BaseException as e:
+      with _run_cache_lock: del _run_cache[key]
+      f.set_exception(e)
+  return f.result()
+
+
+class DiskCache (object):
+  """
+  Program results kept on disk between test runs
+
+  Entries are keyed by a hash of the program's contents plus everything
+  else that affects what it does (arguments, stdin, ...), so they're only
+  used again when nothing relevant has changed.  Each entry is a file.
+  Using one updates its modification time, and prune() removes entries
+  that haven't been used for max_age seconds, and then the least recently
+  used ones until they take up no more than max_bytes.
+
+  Values are tuples of ints, strings and bytes (as run_ex() returns), and
+  are stored as JSON, so a cache directory can't run code when it's read.
+  """
+  def __init__ (self, path=".test_cache", max_bytes=64*1024*1024,
+                max_age=7*24*60*60):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self._hashes = {}
+
+  def _file_hash (self, filename):
+    st = os.stat(filename)
+    k = (os.path.realpath(filename), st.st_mtime_ns, st.st_size)
+    h = self._hashes.get(k)
+    if h is None:
+      with open(filename, "rb") as f:
+        h = self._hashes[k] = hashlib.sha256(f.read()).hexdigest()
+    return h
+
+  def key (self, prog, *parts):
+    h = hashlib.sha256(self._file_hash(prog).encode("ascii"))
+    h.update(repr(parts).encode("utf8"))
+    return h.hexdigest()
+
+  def get (self, key):
+    """
+    Returns the value for key, or None
+    """
+    fn = os.path.join(self.path, key)
+    try:
+      with open(fn, encoding="utf8") as f:
+        value = json.load(f)
+      value = tuple(base64.b64decode(x['b64']) if isinstance(x, dict) else x
+                    for x in value)
+      os.utime(fn)
+      return value
+    except (OSError, ValueError, TypeError, KeyError):
+      return None
+
+  def put (self, key, value):
+    os.makedirs(self.path, exist_ok=True)
+    fn = os.path.join(self.path, key)
+    tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}"
+    value = [dict(b64=base64.b64encode(x).decode("ascii"))
+             if isinstance(x, bytes) else x for x in value]
+    with open(tmp, "w", encoding="utf8") as f:
+      json.dump(value, f)
+    os.replace(tmp, fn)
+
+  def prune (self):
+    try:
+      names = os.listdir(self.path)
+    except OSError:
+      return
+    now = time.time()
+    entries = []
+    for n in names:
+      fn = os.path.join(self.path, n)
+      try:
+        st = os.stat(fn)
+      except OSError:
+        continue
+      if now - st.st_mtime > self.max_age: self._remove(fn)
+      else: entries.append((st.st_mtime, st.st_size, fn))
+    entries.sort(reverse=True)
+    total = 0
+    for _,size,fn in entries:
+      total += size
+      if total > self.max_bytes: self._remove(fn)
+
+  @staticmethod
+  def _remove (fn):
+    # Another test run may be pruning the same directory
+    try:
+      os.remove(fn)
+    except OSError:
+      pass
+
+
+# Set by main() unless --no-cache or --gradescope is given
+_disk_cache = None
+
+def _disk_cached (prog, parts, fn):
+  """
+  Returns fn()'s result, or what it was last time for the same prog and
+  parts if it's in the disk cache (if there is one)
+  """
+  if _disk_cache is None: return fn()
+  key = _disk_cache.key(prog, *parts)
+  value = _disk_cache.get(key)
+  if value is None:
+    value = fn()
+    _disk_cache.put(key, value)
+  return value
+
+
 class SimpleTest (object):
   class Case (unittest.TestCase):
     prog = None
@@ -184,23 +579,78 @@ class SimpleTest (object):
     expect_err = ""
     timeout = 5
     maxDiff = 2048
+    text_stdout = True # If False, self.r is the raw bytes of stdout
+    cache_runs = True # Share results with identical runs (see _run_program())
+    batch = True # May share a process with other tests (see _batch_args())
+
+    _pending = None # Future for a run started early by prefetch()
 
     def _extraSetUp (self):
       pass
 
-    def setUp (self):
-      a = self.args
+    def _has_extra_setup (self):
+      # Tests with their own _extraSetUp() have to run it in setUp(), in
+      # order, so their programs can't be started ahead of time
+      return type(self)._extraSetUp is not SimpleTest.Case._extraSetUp
+
+    def _run_program (self):
+      """
+      Runs the program for this test, returning (rc, stdout, stderr)
+
+      Tests often run exactly the same thing (e.g., several test methods,
+      or subclasses which only change the checking), so unless cache_runs
+      is turned off, the results are shared by every run with the same
+      program (and modification time), arguments, stdin and timeout.
+      When run from main() (other than for grading), results are also kept
+      on disk between runs (see DiskCache) unless --no-cache is given.
+      Scenarios that must really run each time (e.g., because of side
+      effects) should set cache_runs = False.
+      """
       if isinstance(self.args, str): self.args = shlex.split(self.args)
       a = [str(x) for x in self.args]
-      if not os.path.isfile(self.prog): self.skipTest("Program doesn't exist")
-      self._extraSetUp()
       stdin = self.stdin
       if isinstance(stdin, str) and self.stdin_newline:
         if not stdin.endswith("\n"): stdin += "\n"
-      self.rc,self.r,self.e = run_ex(self.prog, stdin, *a, timeout=self.timeout)
+      def run ():
+        return run_ex(self.prog, stdin, *a, timeout=self.timeout,
+                      text=self.text_stdout)
+      if not self.cache_runs or not isinstance(stdin, (type(None), str, bytes)):
+        return run()
+      parts = (tuple(a), stdin, self.timeout, self.text_stdout)
+      st = os.stat(self.prog)
+      key = (os.path.realpath(self.prog), st.st_mtime_ns, st.st_size) + parts
+      return _cached_run(key, lambda: _disk_cached(self.prog, parts, run))
+
+    def _prefetch (self, pool):
+      if self._has_extra_setup(): return
+      if os.path.isfile(self.prog): self._pending = pool.submit(self._run_program)
+
+    def _batch_args (self):
+      """
+      Returns the arguments for running this test with run_batch(), or None
+
+      A batched test only gets the standard error from its own commands
+      (standard output is empty), so tests which check standard output or
+      need stdin or other setup aren't batched.  Neither are tests with
+      batch or cache_runs turned off.  Batched results aren't cached, since
+      they aren't the whole output of a run.
+      """
+      if not (self.batch and self.cache_runs and self.text_stdout): return None
+      if self.stdin is not None or self.expect is not False: return None
+      if self._has_extra_setup(): return None
+      if isinstance(self.args, str): self.args = shlex.split(self.args)
+      return tuple(str(x) for x in self.args)
+
+    def setUp (self):
+      if not os.path.isfile(self.prog): self.skipTest("Program doesn't exist")
+      self._extraSetUp()
+      if self._pending: run = self._pending.result()
+      else: run = self._run_program()
+      self.rc,self.r,self.e = run
 
     def test (self):
-      sout = _indent(self.r).rstrip()
+      sout = ""
+      if self.text_stdout: sout = _indent(self.r).rstrip()
       serr = _indent(self.e).rstrip()
       msg = [""]
       if sout:
@@ -267,6 +717,99 @@ class AllTestResult (unittest.TestResult):
 
 
 
+def _iter_tests (suite):
+  for t in suite:
+    if isinstance(t, unittest.TestSuite):
+      yield from _iter_tests(t)
+    else:
+      yield t
+
+
+BATCH_SIZE = 64 # Most scenarios to run in one process
+
+def _run_batch_into (prog, chunk, futures):
+  """
+  Runs a chunk of [(args, tests)] from prefetch() and sets their futures
+
+  If they can't be run as a batch (for whatever reason), they're run one
+  at a time instead, so every future always gets set.
+  """
+  timeout = max(t.timeout for _,tests in chunk for t in tests)
+  try:
+    results = run_batch(prog, [a for a,_ in chunk], timeout=timeout)
+  except Exception:
+    results = None
+  for i,((a,tests),f) in enumerate(zip(chunk, futures)):
+    if results:
+      rc,err = results[i]
+      f.set_result((rc, "", err))
+      continue
+    try:
+      f.set_result(tests[0]._run_program())
+    except Exception as e:
+      f.set_exception(e)
+
+
+def prefetch (suite, jobs, batch=False):
+  """
+  Starts the programs for the tests in suite running, jobs at a time
+
+  Tests that know how (SimpleTest and Valgrind cases, other than ones with
+  their own _extraSetUp()) have their program started in a thread pool, and
+  their setUp() then just waits for the result.  The tests themselves still run one at a time, in order, in the
+  runner, so results, scoring and skipping all work the same.  Returns the
+  pool, which should be shut down once the tests have run.
+
+  If batch is true, tests which can be (see SimpleTest's _batch_args())
+  are instead grouped by program and run many to a process with
+  run_batch(), split into at least jobs processes.
+  """
+  pool = concurrent.futures.ThreadPoolExecutor(jobs)
+  batches = {}
+  for t in _iter_tests(suite):
+    a = t._batch_args() if batch and hasattr(t, "_batch_args") else None
+    if a is not None and os.path.isfile(t.prog):
+      batches.setdefault(t.prog, {}).setdefault(a, []).append(t)
+    elif hasattr(t, "_prefetch"):
+      t._prefetch(pool)
+  for prog,by_args in batches.items():
+    items = list(by_args.items())
+    n = max(1, min(BATCH_SIZE, -(-len(items) // jobs)))
+    for i in range(0, len(items), n):
+      chunk = items[i:i+n]
+      futures = []
+      for a,tests in chunk:
+        f = concurrent.futures.Future()
+        for t in tests: t._pending = f
+        futures.append(f)
+      pool.submit(_run_batch_into, prog, chunk, futures)
+  return pool
+
+
+class ParallelTestRunner (unittest.TextTestRunner):
+  """
+  A TextTestRunner which runs the tests' programs in parallel
+
+  See prefetch().  jobs defaults to default_jobs, or else the number of
+  CPUs, and batch to default_batch.
+  """
+  default_jobs = None
+  default_batch = False
+
+  def __init__ (self, *args, jobs=None, batch=None, **kw):
+    super().__init__(*args, **kw)
+    self.jobs = jobs or self.default_jobs or os.cpu_count() or 1
+    self.batch = self.default_batch if batch is None else batch
+
+  def run (self, test):
+    pool = prefetch(test, self.jobs, batch=self.batch)
+    try:
+      return super().run(test)
+    finally:
+      pool.shutdown(wait=True, cancel_futures=True)
+
+
+
 def tabulate (results, skip_after_fail=False):
   """
   Tabulates scores in a way compatible with GradeScope
@@ -390,12 +933,16 @@ def tabulate (results, skip_after_fail=False):
 
 
 def gradescope_score (skip_after_fail=False, failfast=False, filename=None,
-                      postprocess=None, extra=None, module='__main__'):
+                      postprocess=None, extra=None, module='__main__',
+                      jobs=None, batch=False):
   if filename is None:
     filename = "/autograder/results/results.json"
   elif filename == "-" or filename is False:
     filename = None
-  runner = unittest.TextTestRunner()
+  if jobs or batch:
+    runner = ParallelTestRunner(jobs=jobs, batch=batch)
+  else:
+    runner = unittest.TextTestRunner()
   runner.failfast = failfast
   runner.resultclass = AllTestResult
   start_time = time.time()
@@ -430,6 +977,9 @@ def main (gs_postprocess=None):
   gs = False
   saf = False
   ff = False
+  jobs = None
+  batch = False
+  cache = True
   modules = []
   args = []
   extra = {}
@@ -443,6 +993,12 @@ def main (gs_postprocess=None):
       saf = True
     elif arg == "--failfast":
       ff = True
+    elif arg.startswith("--jobs="):
+      jobs = int(arg.split("=", 1)[1])
+    elif arg == "--no-cache":
+      cache = False
+    elif arg == "--batch":
+      batch = True
     elif arg.startswith("--modules="):
       modules = arg.split("=",1)[1].split(",")
     else:
@@ -456,6 +1012,11 @@ def main (gs_postprocess=None):
   del sys.argv[1:]
   sys.argv.extend(args)
 
+  if cache and gs is False: # Grading always runs everything
+    global _disk_cache
+    _disk_cache = DiskCache()
+    _disk_cache.prune()
+
   module = '__main__'
   # Wow, this is truly, truly terrible.
   if modules:
@@ -477,12 +1038,74 @@ def main (gs_postprocess=None):
 
   if gs is not False:
     gradescope_score(filename=gs, skip_after_fail=saf, failfast=ff,
-                     postprocess=gs_postprocess, extra=extra, module=module)
+                     postprocess=gs_postprocess, extra=extra, module=module,
+                     jobs=jobs, batch=batch)
+  elif jobs or batch:
+    # Passing the class lets unittest give it the usual options (-v, -f...)
+    ParallelTestRunner.default_jobs = jobs
+    ParallelTestRunner.default_batch = batch
+    unittest.main(module, testRunner=ParallelTestRunner, failfast=ff or None)
   else:
-    unittest.main(module)
+    unittest.main(module, failfast=ff or None)
 
 
 
+class _OutcomeRecorder (object):
+  """
+  Wraps a TestResult, noting in _passed which test classes pass
+  """
+  def __init__ (self, result):
+    object.__setattr__(self, "_result", result)
+
+  def __getattr__ (self, name):
+    return getattr(self._result, name)
+
+  def __setattr__ (self, name, value):
+    # Suites keep state on the result; keep it on the real one
+    setattr(self._result, name, value)
+
+  def _note (self, test, passed):
+    cls = type(test)
+    _passed[cls] = _passed.get(cls, True) and passed
+
+  def addSuccess (self, test):
+    self._note(test, True)
+    return self._result.addSuccess(test)
+
+  def addFailure (self, test, err):
+    self._note(test, False)
+    return self._result.addFailure(test, err)
+
+  def addError (self, test, err):
+    self._note(test, False)
+    return self._result.addError(test, err)
+
+  def addSkip (self, test, reason):
+    self._note(test, False)
+    return self._result.addSkip(test, reason)
+
+  def addExpectedFailure (self, test, err):
+    self._note(test, True)
+    return self._result.addExpectedFailure(test, err)
+
+  def addUnexpectedSuccess (self, test):
+    self._note(test, False)
+    return self._result.addUnexpectedSuccess(test)
+
+  def addSubTest (self, test, subtest, err):
+    if err is not None: self._note(test, False)
+    return self._result.addSubTest(test, subtest, err)
+
+
+class _RecordingSuite (unittest.TestSuite):
+  """
+  A TestSuite which records which classes pass, for skipIfFailed()
+  """
+  def run (self, result, debug=False):
+    super().run(_OutcomeRecorder(result), debug)
+    return result
+
+
 def load_tests (loader, standard_tests, pattern):
   """
   Runs discovered test classes in order
@@ -497,6 +1120,9 @@ def load_tests (loader, standard_tests, pattern):
   are not in the same order they're defined in the file.  So for each one,
   we get the first line number of the class and use that to return
   a new TestSuite sorted in line-number order.
+
+  Classes which others depend on with skipIfFailed() are moved ahead of
+  them if need be, and the suite keeps track of which classes pass.
   """
   if not isinstance(standard_tests, unittest.TestSuite): return standard_tests
   subsuites = []
@@ -515,8 +1141,20 @@ def load_tests (loader, standard_tests, pattern):
       first_line_cls = inspect.getsourcelines(cls)[1]
       subsuites.append((mod,first_line_cls,first_line_m,test))
   subsuites.sort()
-  subsuites = [x[-1] for x in subsuites]
-  return unittest.TestSuite(subsuites)
+
+  by_class = {}
+  for x in subsuites:
+    by_class.setdefault(type(x[-1]), []).append(x[-1])
+  ordered = []
+  def visit (cls, waiting=()):
+    if cls in ordered: return
+    if cls in waiting: raise ValueError(f"{cls.__name__} depends on itself")
+    for dep in getattr(cls, "_depends_on", ()):
+      if dep in by_class: visit(dep, waiting + (cls,))
+    ordered.append(cls)
+  for cls in by_class: visit(cls)
+
+  return _RecordingSuite(t for cls in ordered for t in by_class[cls])
 
 
 
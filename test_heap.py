@@ -7,7 +7,7 @@ import tempfile
 from unittest import skipIf
 
 from test_common import Valgrind, SimpleTest, skipIfFailed, load_tests
-
+from test_common import parse_records, read_heap_dumps
 _WEIGHT = 0.5
 
 def clean (s):
@@ -420,7 +420,7 @@ class SegFault (HeapTest.Case):
   rel 1
   alignbrk
   malloc 1 20
-  showheap poke 1 4200
+  showheap poke 1 4200 0
   """
 
   def test (self):
@@ -1098,45 +1098,407 @@ class AllocReallocFreeAssortment (HeapTest.Case):
   """
 
 
-"""
-# Generates random events for testing
+class ScriptStdin (HeapTest.Case):
+  """
+  Commands can be piped in on stdin instead of given as arguments
+  """
+  args = """
+  script -
+  """
+
+  stdin = """
+  # Comments are skipped
+  rel 1 -- alignbrk
+  malloc 1 8
+  malloc 2 8 # so are trailing ones
+  free 1
+  showheap
+  """
+
+  expected = """
+  -- heap --
+  0x00000000 0x00000010 FREE
+  0x00000010 0x00000010 USED
+  0x00000020 0x00000000 XXXX
+  """
+
+
+class BenchCounts (HeapTest.Case):
+  """
+  The bench block repeats its body and reports each kind of call
+  """
+  args = """
+  bench 5
+    malloc 1 8 -- malloc 2 24 -- realloc 1 64 -- free 1 -- free 2
+    calloc 3 2 12 -- free 3
+  end
+  checksentinel
+  """
+
+  def _check_output (self):
+    recs = {r['op']:r for r in parse_records(self.e, "bench")}
+    self.assertEqual(sorted(recs),
+                     ["all", "calloc", "free", "malloc", "realloc"])
+    self.assertEqual(recs['malloc']['count'], 10)
+    self.assertEqual(recs['free']['count'], 15)
+    self.assertEqual(recs['realloc']['count'], 5)
+    self.assertEqual(recs['calloc']['count'], 5)
+    self.assertEqual(recs['all']['count'], 35)
+    for op in "malloc free realloc calloc".split():
+      r = recs[op]
+      self.assertLessEqual(r['p50_ns'], r['p99_ns'])
+      self.assertLessEqual(r['p99_ns'], r['p999_ns'])
+      self.assertLessEqual(r['p999_ns'], r['max_ns'])
+
+
+class Workloads (HeapTest.Case):
+  """
+  Generated workloads run cleanly and everything they leave can be freed
+  """
+  args = """
+  rel 1
+  alignbrk
+  workload churn 2000 64 300 1
+  workload powerlaw 2000 64 4096 2
+  freeall
+  workload lifo 2000 64 300 3
+  workload fifo 2000 64 300 4
+  freeall
+  workload prodcons 2000 64 300 5
+  freeall
+  workload realloc 2000 64 300 6
+  freeall
+  checksentinel
+  showheap
+  """
+
+  expected = """
+  -- heap --
+  0x00000000 0x00000000 XXXX
+  """
+
+
+class Calloc (HeapTest.Case):
+  """
+  calloc() allocates nmemb * size bytes
+  """
+  args = """
+  rel 1 -- alignbrk
+  calloc 1 3 12
+  calloc 2 1 8
+  showheap
+  showslots
+  """
+
+  expected = """
+  -- heap --
+  0x00000000 0x00000030 USED
+  0x00000030 0x00000010 USED
+  0x00000040 0x00000000 XXXX
+  -- slots --
+  slot num:0x00000001 ptr:0x00000008 sz:0x00000024
+  slot num:0x00000002 ptr:0x00000038 sz:0x00000008
+  """
+
+
+class ManySlots (HeapTest.Case):
+  """
+  The slot table can be made larger than the default 256 slots
+  """
+  args = """
+  rel 1 -- alignbrk
+  slots 100000
+  malloc 99999 8
+  malloc 50000 8
+  malloc 7 8
+  free 7
+  showslots
+  freeall
+  showslots
+  """
+
+  expected = """
+  -- slots --
+  slot num:0x0000c350 ptr:0x00000018 sz:0x00000008
+  slot num:0x0001869f ptr:0x00000008 sz:0x00000008
+  -- slots --
+  """
+
+
+class CheckWords (HeapTest.Case):
+  """
+  Word-wide checks report a bad byte as precisely as byte checks
+  """
+  args = """
+  rel 1 -- alignbrk
+  checks 2
+  malloc 1 100
+  fillslot 1 0 0x5a
+  poke 1 37 0
+  checkslot 1 0x5a
+  """
+
+  expect_fail = True
+
+  expected = """
+  ** Bad check value at 0x0000002d (real 0x00 != expected 0x5a)
+  """
+
+
+class CheckSampledEdges (HeapTest.Case):
+  """
+  Sampled checks still look at the bytes right before the next header
+  """
+  args = """
+  rel 1 -- alignbrk
+  checks 3
+  malloc 1 1000
+  poke 1 998 0xff
+  poke 1 999 0x00
+  free 1
+  """
+
+  expect_fail = True
+
+  def _check_output (self):
+    # The expected value depends on the address, and may be one of the
+    # values we poked, so accept either byte.
+    self.assertRegex(self.e.strip(),
+        r"^\*\* Bad check value at 0x000003e(e|f) \(real 0x(ff|00) != ")
 
-import random
-def generate_events (num_blocks, sizes_f, num_reallocs_f):
-  block_events = [] # "Stacks" of events
-  stacks_choice = []
 
-  for i in range(num_blocks):
-    events = []
-    block_events.append(events)
-    events.append(f"malloc {i} {sizes_f(i,0)}")
-    for j in range(num_reallocs_f(i)):
-      events.append(f"realloc {i} {sizes_f(i,1+j)}")
-    events.append(f"free {i}")
-    stacks_choice.extend([i] * len(events))
+class HeapDumpMatchesShowheap (HeapTest.Case):
+  """
+  Binary heap dumps on stdout describe the same blocks as showheap
+  """
+  args = """
+  rel 1 -- alignbrk
+  malloc 1 8 -- malloc 2 40 -- malloc 3 8 -- malloc 4 8
+  free 2
+  dumpheap -
+  v 0 -- showheap
+  free 4
+  dumpheap -
+  showheap
+  """
 
-  all_events = []
-  random.shuffle(stacks_choice)
-  for stack in stacks_choice:
-    e = block_events[stack].pop(0)
-    all_events.append(e)
+  text_stdout = False
 
-  return all_events
+  def _check_output (self):
+    dumps = read_heap_dumps(self.r)
+    self.assertEqual(len(dumps), 2)
+    self.assertEqual(clean([d.text() for d in dumps]), clean(self.e))
+    self.assertEqual(dumps[0].diff(dumps[1]),
+                     [(0x50, (0x10, 1), (0, 2)), (0x60, (0, 2), None)])
 
-def get_size (block, alloc_num):
-  return random.randint(0, 256)
 
-def get_num_reallocs (block):
-  return 0
-  r = random.randint(0, 8)
-  if r > 5: r = 0
-  return r
+class HeapDumpEmpty (HeapTest.Case):
+  """
+  A heap dump before anything has been allocated has no blocks
+  """
+  args = "dumpheap -"
 
-print("\n".join(generate_events(30, get_size, get_num_reallocs)))
-import sys
-sys.exit()
-"""
+  text_stdout = False
 
+  def _check_output (self):
+    dumps = read_heap_dumps(self.r)
+    self.assertEqual([len(d) for d in dumps], [0])
+
+
+class FragReport (HeapTest.Case):
+  """
+  Utilization and fragmentation figures for a heap with two holes
+  """
+  args = """
+  rel 1 -- alignbrk
+  malloc 1 8 -- malloc 2 40 -- malloc 3 8 -- malloc 4 100 -- malloc 5 8
+  free 2 -- free 4
+  fragreport
+  """
+
+  expected = """
+  frag brk_size=216 used=48 payload=24 free=160 overhead=48 used_blocks=3 free_blocks=2 largest_free=112 ext_frag_ppm=300000
+  fraghist min=32 max=63 count=1
+  fraghist min=64 max=127 count=1
+  """
+
+
+class FragReportEmpty (HeapTest.Case):
+  """
+  A fragmentation report before anything has been allocated
+  """
+  args = "fragreport"
+
+  expected = """
+  frag brk_size=0 used=0 payload=0 free=0 overhead=0 used_blocks=0 free_blocks=0 largest_free=0 ext_frag_ppm=0
+  """
+
+
+class RepeatAndRanges (HeapTest.Case):
+  """
+  A repeat block and commands over ranges of slots
+  """
+  args = """
+  rel 1 -- alignbrk
+  malloc 0..3 8
+  repeat 3
+    free 1..2
+    malloc 1..2 16
+  end
+  showheap
+  free 0..3
+  showheap
+  """
+
+  expected = """
+  -- heap --
+  0x00000000 0x00000010 USED
+  0x00000010 0x00000020 USED
+  0x00000030 0x00000010 USED
+  0x00000040 0x00000018 USED
+  0x00000058 0x00000000 XXXX
+  -- heap --
+  0x00000000 0x00000000 XXXX
+  """
+
+
+class BadSlotRange (HeapTest.Case):
+  """
+  Slot ranges must go upwards
+  """
+  expect_fail = True
+  args = """
+  malloc 3..1 8
+  """
+
+  expected = """
+  Bad slot range.
+  """
+
+
+class SnapshotRestore (HeapTest.Case):
+  """
+  Branching twice off a saved heap
+  """
+  args = """
+  rel 1 -- alignbrk
+  malloc 0..3 8 -- free 1
+  snapshot 0
+  malloc 5 100 -- free 0..3
+  showheap
+  restore 0
+  checkslot 0..3 -1
+  free 0 -- free 2..3
+  restore 0
+  showheap
+  showslots
+  """
+
+  expected = """
+  -- heap --
+  0x00000000 0x00000040 FREE
+  0x00000040 0x00000070 USED
+  0x000000b0 0x00000000 XXXX
+  -- heap --
+  0x00000000 0x00000010 USED
+  0x00000010 0x00000010 FREE
+  0x00000020 0x00000010 USED
+  0x00000030 0x00000010 USED
+  0x00000040 0x00000000 XXXX
+  -- slots --
+  slot num:0x00000000 ptr:0x00000008 sz:0x00000008
+  slot num:0x00000002 ptr:0x00000028 sz:0x00000008
+  slot num:0x00000003 ptr:0x00000038 sz:0x00000008
+  """
+
+
+class Scenarios (HeapTest.Case):
+  """
+  Each scenario starts with a fresh (zeroed) heap and slots
+  """
+  batch = False # Its own scenario markers would confuse the batch's
+
+  args = """
+  scenario 1 rel 1 -- alignbrk -- slots 4 -- malloc 0..3 8 -- showbrk
+  scenario 2 rel 1 -- alignbrk -- showslots -- malloc 0 8 -- showbrk
+  showheap
+  scenario 3 rel 1 -- checks 0 -- alignbrk -- malloc 0 8 -- peek 0 0
+  """
+
+  expected = """
+  == scenario 1
+  brk: 0x00000048
+  == end 1
+  == scenario 2
+  -- slots --
+  brk: 0x00000018
+  -- heap --
+  0x00000000 0x00000010 USED
+  0x00000010 0x00000000 XXXX
+  == end 2
+  == scenario 3
+  peek 0x00000008 0x00
+  == end 3
+  """
+
+
+class ScenarioErrors (HeapTest.Case):
+  """
+  A bad command only ends its own scenario
+  """
+  batch = False # Its own scenario markers would confuse the batch's
+  expect_fail = True
+
+  args = """
+  scenario 1 rel 1 -- malloc 0 8 -- malloc 1
+  scenario 2 repeat 2 malloc 1 8
+  scenario 3 rel 1 -- alignbrk -- malloc 0 8 -- showbrk
+  """
+
+  expected = """
+  == scenario 1
+  Bad number of arguments for 'malloc'.
+  == end 1 1
+  == scenario 2
+  Missing 'end' for block.
+  == end 2 1
+  == scenario 3
+  brk: 0x00000018
+  == end 3
+  """
+
+
+class RecordReplay (HeapTest.Case):
+  """
+  Replaying a recorded trace puts every block back where it was
+  """
+  cache_runs = False # Needs the trace file it writes
+  args = "script -"
+  script = """
+  rel 1 -- alignbrk -- slots 1000
+  record {path}
+  malloc 0..3 8 -- free 1 -- realloc 2 40 -- malloc 4 100 -- calloc 5 3 12
+  malloc 999 8
+  record off
+  showheap
+  freeall -- slots 256
+  replay {path} 0
+  showheap
+  """
+
+  def _extraSetUp (self):
+    d = tempfile.TemporaryDirectory()
+    self.addCleanup(d.cleanup)
+    self.stdin = self.script.format(path=os.path.join(d.name, "trace"))
+
+  def _check_output (self):
+    replay = parse_records(self.e, "replay")
+    self.assertEqual(len(replay), 1)
+    self.assertEqual(replay[0]['count'], 9)
+    self.assertEqual(replay[0]['moved'], 0)
+    heaps = self.e.split("-- heap --")
+    self.assertEqual(len(heaps), 3)
+    self.assertEqual(clean(heaps[1].split("replay")[0]), clean(heaps[2]))
 
 
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Tests for the tools around heap.c rather than for heap.c itself
+
+These check heapview.py, heapsim.py, stress.py and the tester-mt build, so
+they need things the heap tests don't (NumPy, libheap.so, threads) and
+aren't part of grading.  "make tool-tests" builds what they need and runs
+them.
+"""
+
+import unittest
+import os
+
+from test_common import load_tests, parse_records
+from test_heap import HeapTest, clean
+import test_heap
+from stress import generate_events, shrink
+
+try:
+  import heapsim
+except ImportError:
+  heapsim = None # Needs NumPy
+
+
+class ThreadsLocked (HeapTest.Case):
+  """
+  Several threads using the heap at once through heaplock.c (tester-mt)
+
+  Sizes stay small enough that realloc() never has to move a block.
+  """
+  prog = "./tester-mt"
+  cache_runs = False # Lock waits and latencies differ from run to run
+  args = """
+  threads 4 5000 8 1
+  checksentinel
+  """
+
+  def _check_output (self):
+    threads = parse_records(self.e, "thread")
+    self.assertEqual([t['id'] for t in threads], [0, 1, 2, 3])
+    for t in threads:
+      self.assertEqual(t['ops'], 5000)
+      self.assertLessEqual(t['p50_ns'], t['p99_ns'])
+    total = parse_records(self.e, "threads")
+    self.assertEqual(len(total), 1)
+    self.assertEqual(total[0]['count'], 4)
+    self.assertEqual(total[0]['ops'], 20000)
+    self.assertEqual(total[0]['lock_waits'], sum(t['lock_waits'] for t in threads))
+
+
+class InProcess (unittest.TestCase):
+  """
+  heap.c called straight from Python (see heapview.py)
+  """
+  def setUp (self):
+    if not os.path.isfile("./libheap.so"):
+      self.skipTest("libheap.so doesn't exist")
+    from heapview import Heap # Only when there's a library for it to load
+    self.h = Heap()
+    self.h.reset()
+
+  def test (self):
+    h = self.h
+    def block (sz): return (sz + h.header_size + 7) // 8 * 8
+    a,b,c = h.malloc(8), h.malloc(100), h.malloc(8)
+    h.free(b)
+    self.assertEqual(a - h.first_block, h.header_size)
+    view = h.view()
+    self.assertEqual(list(view.blocks()), [
+      (0, block(8), view.USED),
+      (block(8), block(100), view.FREE),
+      (block(8) + block(100), block(8), view.USED),
+      (2 * block(8) + block(100), 0, view.SENTINEL)])
+    h.free(a)
+    h.free(c)
+    self.assertEqual(list(h.view().blocks()), [(0, 0, view.SENTINEL)])
+
+
+class StressTrace (HeapTest.Case):
+  """
+  A long random trace leaves every block's contents and the sentinel alone
+  """
+  args = """
+  script -
+  """
+
+  expected = """
+  """
+
+  def _extraSetUp (self):
+    self.stdin = "\n".join(["rel 1", *generate_events(2000, seed=1),
+                            "checksentinel", "freeall", "checksentinel"])
+
+
+class Shrink (unittest.TestCase):
+  """
+  stress.shrink() cuts a failing trace down to just what makes it fail
+  """
+  def test (self):
+    events = list(generate_events(500, seed=2))
+    a,b = events[40],events[700]
+    def fails (evs):
+      return a in evs and b in evs[evs.index(a) + 1:]
+    self.assertEqual(shrink(events, fails), [a, b])
+
+
+class Simulated (unittest.TestCase):
+  """
+  heapsim.py's model gives the same output as the heap scenarios here
+  """
+  def test (self):
+    if heapsim is None: self.skipTest("NumPy isn't installed")
+    for cls in list(vars(test_heap).values()):
+      if not isinstance(cls, type) or not issubclass(cls, HeapTest.Case):
+        continue
+      if cls.expect_fail or cls.test is not HeapTest.Case.test: continue
+      if cls._check_output is not HeapTest.Case._check_output: continue
+      args = cls.args
+      if not isinstance(args, str): args = " ".join(str(a) for a in args)
+      try:
+        rc,out = heapsim.Tester().run(args)
+      except ValueError:
+        continue # Uses something the model doesn't do
+      with self.subTest(cls.__name__):
+        self.assertEqual(clean(cls.expected), clean(out))
+
+
+if __name__ == "__main__":
+  from test_common import main
+  main()
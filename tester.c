@@ -4,6 +4,15 @@
 #include <string.h>
 #include <unistd.h>
 #include <stdbool.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <time.h>
+#include <signal.h>
+#include <sys/resource.h>
+#include <sys/stat.h>
+#ifdef HEAP_LOCK
+#include <pthread.h>
+#endif
 #include "util.h"
 
 void * MALLOC (size_t sz);
@@ -18,15 +27,122 @@ typedef struct
   int is_used;
 } Block;
 
+#ifdef NO_HEAP_WALK
+// Built against some other allocator for comparison (see the bench targets
+// in the Makefile), so there are no Blocks to look at.
+Block * first_block = NULL;
+#define NEED_BLOCKS()                                    \
+  do {                                                   \
+    print("This build can't look at heap blocks.\n");    \
+    exit(1);                                             \
+  } while (0)
+#else
 extern Block * first_block;
+#define NEED_BLOCKS() do {} while (0)
+#endif
 
 typedef struct
 {
   void * ptr;
   size_t sz;
+  uint32_t live; // Index in live[] plus one, or 0 if the slot is empty
 } AllocInfo;
 
-static AllocInfo slots[256];
+// The slot table is mmap()ed so it can be large without coming from either
+// heap; untouched pages don't cost anything.  Slots which are in use are
+// also listed (unordered) in live[], so that going over them takes time
+// proportional to how many there are rather than to the capacity.  Slots
+// should only be changed with setslot(), which keeps live[] up to date.
+
+#define DEFAULT_SLOTS 256
+
+static AllocInfo * slots;
+static uint32_t * live;
+static uint32_t num_slots;
+static uint32_t num_live;
+
+static void * map_zeroed (size_t sz)
+{
+  void * p = mmap(NULL, sz, PROT_READ | PROT_WRITE,
+                  MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+  ASSERT2(p != MAP_FAILED, "Couldn't map memory");
+  return p;
+}
+
+static void set_capacity (uint32_t n)
+{
+  AllocInfo * ns = map_zeroed(n * sizeof(AllocInfo));
+  uint32_t * nl = map_zeroed(n * sizeof(uint32_t));
+  for (uint32_t i = 0; i < num_live; ++i)
+  {
+    uint32_t slot = live[i];
+    ASSERT2(slot < n, "Slot in use beyond new capacity");
+    ns[slot] = slots[slot];
+    nl[i] = slot;
+  }
+  if (slots)
+  {
+    munmap(slots, num_slots * sizeof(AllocInfo));
+    munmap(live, num_slots * sizeof(uint32_t));
+  }
+  slots = ns;
+  live = nl;
+  num_slots = n;
+}
+
+static void setslot (uint32_t slot, void * ptr, size_t sz)
+{
+  ASSERT2(slot < num_slots, "Bad slot number");
+  AllocInfo * ai = slots + slot;
+  bool used = ptr || sz;
+  if (used && !ai->live)
+  {
+    live[num_live++] = slot;
+    ai->live = num_live;
+  }
+  else if (!used && ai->live)
+  {
+    uint32_t last = live[--num_live];
+    live[ai->live - 1] = last;
+    slots[last].live = ai->live;
+    ai->live = 0;
+  }
+  ai->ptr = ptr;
+  ai->sz = sz;
+}
+
+static void sift_down (uint32_t i, uint32_t n)
+{
+  while (true)
+  {
+    uint32_t c = 2 * i + 1;
+    if (c >= n) break;
+    if (c + 1 < n && live[c + 1] > live[c]) ++c;
+    if (live[i] >= live[c]) break;
+    uint32_t t = live[i]; live[i] = live[c]; live[c] = t;
+    i = c;
+  }
+}
+
+// Sorts live[] by slot number, so slots can be gone over in order.
+static void sort_live ()
+{
+  // Heapsort, since qsort() may want memory.
+  for (uint32_t i = num_live / 2; i-- > 0;) sift_down(i, num_live);
+  for (uint32_t n = num_live; n-- > 1;)
+  {
+    uint32_t t = live[0]; live[0] = live[n]; live[n] = t;
+    sift_down(0, n);
+  }
+  for (uint32_t i = 0; i < num_live; ++i) slots[live[i]].live = i + 1;
+}
+
+// An argument to a command, already converted from its word.
+typedef union
+{
+  uint32_t n;
+  const char * s;
+} Arg;
 
 static int relative_addrs = 0;
 static int verbose = 1;
@@ -51,19 +167,156 @@ static uint8_t hash (void * ptr, size_t sz, int offset)
   return h & 0xff;
 }
 
-static void do_sbrk (char ** args)
+// ---------------------------------------------------------------------------
+//  Timing
+// ---------------------------------------------------------------------------
+
+// While timing is on (inside a bench block), each call into the heap under
+// test is timed and its latency recorded in a log-linear histogram: exact
+// below 16ns, then 16 buckets per power of two (so within about 6%).  Only
+// the call itself is timed, not the check value fill/verify around it.
+
+#define T_MALLOC 0
+#define T_FREE 1
+#define T_REALLOC 2
+#define T_CALLOC 3
+#define T_COUNT 4
+
+static const char * timed_names[T_COUNT] = {"malloc", "free", "realloc",
+                                            "calloc"};
+
+#define HIST_SUB 16
+#define HIST_BUCKETS (HIST_SUB + 60 * HIST_SUB)
+
+typedef struct
+{
+  uint32_t hist[HIST_BUCKETS];
+  uint64_t count;
+  uint64_t total_ns;
+  uint64_t max_ns;
+} Latency;
+
+static bool timing = false;
+static Latency latency[T_COUNT];
+
+static uint64_t now_ns ()
+{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t)ts.tv_sec * 1000000000u + ts.tv_nsec;
+}
+
+static int hist_bucket (uint64_t ns)
+{
+  if (ns < HIST_SUB) return ns;
+  int e = 63 - __builtin_clzll(ns); // >= 4
+  int b = HIST_SUB + (e - 4) * HIST_SUB + ((ns >> (e - 4)) & (HIST_SUB - 1));
+  if (b >= HIST_BUCKETS) b = HIST_BUCKETS - 1;
+  return b;
+}
+
+// The largest value that falls in bucket b.
+static uint64_t hist_value (int b)
+{
+  if (b < HIST_SUB) return b;
+  int e = (b - HIST_SUB) / HIST_SUB + 4;
+  uint64_t sub = (b - HIST_SUB) % HIST_SUB;
+  return ((HIST_SUB + sub + 1) << (e - 4)) - 1;
+}
+
+static void hist_add (Latency * l, uint64_t ns)
+{
+  l->hist[hist_bucket(ns)]++;
+  l->count++;
+  l->total_ns += ns;
+  if (ns > l->max_ns) l->max_ns = ns;
+}
+
+// Adds everything recorded in from into l.
+static void hist_merge (Latency * l, Latency * from)
+{
+  for (int b = 0; b < HIST_BUCKETS; ++b) l->hist[b] += from->hist[b];
+  l->count += from->count;
+  l->total_ns += from->total_ns;
+  if (from->max_ns > l->max_ns) l->max_ns = from->max_ns;
+}
+
+static void record_latency (int op, uint64_t ns)
+{
+  hist_add(latency + op, ns);
+}
+
+// Latency (in ns) at the given fraction (in parts per thousand) of calls.
+static uint64_t percentile (Latency * l, uint32_t permille)
+{
+  if (!l->count) return 0;
+  uint64_t want = (l->count * permille + 999) / 1000;
+  uint64_t seen = 0;
+  for (int b = 0; b < HIST_BUCKETS; ++b)
+  {
+    seen += l->hist[b];
+    if (seen >= want)
+    {
+      uint64_t v = hist_value(b);
+      return v < l->max_ns ? v : l->max_ns;
+    }
+  }
+  return l->max_ns;
+}
+
+// Times statement stmt as a call of type op if timing is on.
+#define TIMED(op, stmt)                                   \
+  do {                                                    \
+    if (!timing) { stmt; break; }                         \
+    uint64_t _t0 = now_ns();                              \
+    stmt;                                                 \
+    record_latency(op, now_ns() - _t0);                   \
+  } while (0)
+
+static void print_kv (const char * key, uint64_t value)
+{
+  sp(); print(key); print("="); printdec(value);
+}
+
+static void report_latency (uint64_t wall_ns)
+{
+  // One line per call type plus a total, as "bench key=value ..." so it's
+  // easy for scripts to pick up.
+  uint64_t count = 0;
+  for (int op = 0; op < T_COUNT; ++op)
+  {
+    Latency * l = latency + op;
+    count += l->count;
+    print("bench op="); print(timed_names[op]);
+    print_kv("count", l->count);
+    print_kv("total_ns", l->total_ns);
+    print_kv("ops_per_sec", l->total_ns ? l->count * 1000000000u / l->total_ns : 0);
+    print_kv("p50_ns", percentile(l, 500));
+    print_kv("p99_ns", percentile(l, 990));
+    print_kv("p999_ns", percentile(l, 999));
+    print_kv("max_ns", l->max_ns);
+    nl();
+  }
+  print("bench op=all");
+  print_kv("count", count);
+  print_kv("wall_ns", wall_ns);
+  print_kv("ops_per_sec", wall_ns ? count * 1000000000u / wall_ns : 0);
+  nl();
+}
+
+static void do_sbrk (Arg * args)
 {
-  sbrk(struint32(args[0]));
+  sbrk(args[0].n);
 }
 
-static void do_showbrk (char ** args)
+static void do_showbrk (Arg * args)
 {
   print("brk: ");
   dumpaddr(sbrk(0));
   nl();
 }
 
-static void do_alignbrk (char ** args)
+static void do_alignbrk (Arg * args)
 {
   intptr_t b = (intptr_t)sbrk(0);
   if (b % 8)
@@ -73,23 +326,25 @@ static void do_alignbrk (char ** args)
   }
 }
 
-static void do_checksentinel (char ** args)
+static void do_checksentinel (Arg * args)
 {
   // Checks that there seems to be a sentinel right beofre program break
   // checksentinel
+  NEED_BLOCKS();
   Block * b = sbrk(0);
   b -= 1;
   ASSERT2(b->size == 0, "Bad sentinel");
   ASSERT2(b->is_used == 1, "Bad sentinel");
 }
 
-static void do_mark (char ** args)
+static void do_mark (Arg * args)
 {
   print("----\n");
 }
 
-static void do_showheap (char ** args)
+static void do_showheap (Arg * args)
 {
+  NEED_BLOCKS();
   Block * b = (Block *)first_block;
   if (verbose) print("-- heap --\n");
   while (true)
@@ -105,6 +360,246 @@ static void do_showheap (char ** args)
   }
 }
 
+// Heap dumps are a binary version of showheap for tools: a header of the
+// four bytes "HEAP", a version (1) and a record count, followed by that many
+// records.  Each record is an offset from first_block, a size and a state
+// (DUMP_FREE, DUMP_USED, DUMP_SENTINEL or DUMP_BAD).  Everything is a native
+// uint32.  The last record is always the sentinel, except that a dump taken
+// before there's a heap at all has no records.
+#define DUMP_FREE 0
+#define DUMP_USED 1
+#define DUMP_SENTINEL 2
+#define DUMP_BAD 3
+
+static void write_all (int fd, void * data, size_t sz)
+{
+  char * d = data;
+  while (sz)
+  {
+    ssize_t n = write(fd, d, sz);
+    ASSERT2(n > 0, "Write failed");
+    d += n;
+    sz -= n;
+  }
+}
+
+static void do_dumpheap (Arg * args)
+{
+  // Writes a binary heap dump to a file, or to stdout if the path is "-"
+  // dumpheap <path>
+  NEED_BLOCKS();
+  int fd = 1;
+  if (strcmp(args[0].s, "-"))
+  {
+    fd = open(args[0].s, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    ASSERT2(fd >= 0, "Couldn't open dump file");
+  }
+
+  uint32_t count = first_block ? 1 : 0;
+  Block * b = first_block;
+  for (; b && b->size; b = (Block *)(((char *)b)+b->size)) ++count;
+
+  static uint32_t buf[3 * 1024];
+  memcpy(buf, "HEAP", 4);
+  buf[1] = 1;
+  buf[2] = count;
+  write_all(fd, buf, 3 * sizeof(uint32_t));
+
+  size_t n = 0;
+  b = first_block;
+  while (b)
+  {
+    uint32_t state = DUMP_BAD;
+    if (b->is_used && !b->size) state = DUMP_SENTINEL;
+    else if (b->is_used && b->size) state = DUMP_USED;
+    else if (!b->is_used && b->size) state = DUMP_FREE;
+    buf[n++] = (char *)b - (char *)first_block;
+    buf[n++] = b->size;
+    buf[n++] = state;
+    if (n == sizeof(buf)/sizeof(buf[0]) || b->size == 0)
+    {
+      write_all(fd, buf, n * sizeof(uint32_t));
+      n = 0;
+    }
+    if (b->size == 0) break;
+    b = (Block *)(((char *)b)+b->size);
+  }
+
+  if (fd != 1) close(fd);
+}
+
+static void do_fragreport (Arg * args)
+{
+  // Walks the heap once and prints utilization and fragmentation figures
+  // as a "frag key=value ..." line, then one "fraghist" line for each
+  // power-of-two size range with free blocks in it.  Sizes include headers;
+  // payload is what's left of the used blocks without them.  ext_frag_ppm
+  // is 1 - largest_free/free, in parts per million.  Before the first
+  // allocation there's no heap, and everything is zero.
+  // fragreport
+  NEED_BLOCKS();
+  uint64_t used_bytes = 0, free_bytes = 0, largest = 0;
+  uint32_t used_blocks = 0, free_blocks = 0, headers = first_block ? 1 : 0;
+  uint32_t hist[32] = {0};
+  Block * b = first_block;
+  for (; b && b->size; b = (Block *)(((char *)b)+b->size))
+  {
+    ++headers;
+    if (b->is_used)
+    {
+      used_bytes += b->size;
+      ++used_blocks;
+      continue;
+    }
+    free_bytes += b->size;
+    ++free_blocks;
+    if (b->size > largest) largest = b->size;
+    hist[31 - __builtin_clz(b->size)]++;
+  }
+
+  print("frag");
+  print_kv("brk_size", first_block ? (char *)sbrk(0) - (char *)first_block : 0);
+  print_kv("used", used_bytes);
+  print_kv("payload", used_bytes - used_blocks * sizeof(Block));
+  print_kv("free", free_bytes);
+  print_kv("overhead", headers * sizeof(Block));
+  print_kv("used_blocks", used_blocks);
+  print_kv("free_blocks", free_blocks);
+  print_kv("largest_free", largest);
+  print_kv("ext_frag_ppm", free_bytes ? 1000000 - largest * 1000000 / free_bytes : 0);
+  nl();
+  for (int i = 0; i < 32; ++i)
+  {
+    if (!hist[i]) continue;
+    print("fraghist");
+    print_kv("min", 1ull << i);
+    print_kv("max", (2ull << i) - 1);
+    print_kv("count", hist[i]);
+    nl();
+  }
+}
+
+// For memstats.  The program break is only checked after calls which can
+// grow it, which is cheap since sbrk(0) doesn't make a system call.
+static char * initial_brk;
+static char * peak_brk;
+
+static void note_brk ()
+{
+  char * b = sbrk(0);
+  if (b > peak_brk) peak_brk = b;
+}
+
+// Peak resident set size in KB.  getrusage()'s figure carries over from
+// before exec() (e.g., from a Python parent), so prefer VmHWM, which doesn't.
+static uint64_t peak_rss_kb ()
+{
+  static char buf[4096];
+  int fd = open("/proc/self/status", O_RDONLY);
+  if (fd >= 0)
+  {
+    ssize_t n = read(fd, buf, sizeof(buf) - 1);
+    close(fd);
+    buf[n > 0 ? n : 0] = 0;
+    char * p = strstr(buf, "VmHWM:");
+    if (p) return strtoull(p + 6, NULL, 10);
+  }
+  struct rusage ru;
+  getrusage(RUSAGE_SELF, &ru);
+  return ru.ru_maxrss;
+}
+
+static void do_memstats (Arg * args)
+{
+  // Prints how far the program break has moved (now and at most) and the
+  // peak resident set size as a "mem key=value ..." line
+  // memstats
+  print("mem");
+  print_kv("brk", (char *)sbrk(0) - initial_brk);
+  print_kv("peak_brk", peak_brk - initial_brk);
+  print_kv("maxrss_kb", peak_rss_kb());
+  nl();
+}
+
+// Snapshots save the heap (everything from first_block up to the break)
+// and the slot table in a mapping of their own, so that several scenarios
+// can branch off from a shared starting point in one run.  Restoring one
+// moves the break back to where it was, copies the heap back into place and
+// replaces the slot table.  Since the heap is always at the same address,
+// the saved pointers are good again afterwards.
+
+#define MAX_SNAPSHOTS 16
+
+typedef struct
+{
+  uint32_t slot;
+  void * ptr;
+  size_t sz;
+} SavedSlot;
+
+typedef struct
+{
+  void * map; // Heap bytes followed by SavedSlots; NULL if unused
+  size_t map_size;
+  Block * first_block;
+  char * brk;
+  size_t heap_size;
+  uint32_t num_slots; // How many SavedSlots
+} Snapshot;
+
+static Snapshot snapshots[MAX_SNAPSHOTS];
+
+static void do_snapshot (Arg * args)
+{
+  // Saves the heap and slots so they can be put back with restore.
+  // snapshot <id>
+  NEED_BLOCKS();
+  ASSERT2(args[0].n < MAX_SNAPSHOTS, "Bad snapshot number");
+  Snapshot * snap = snapshots + args[0].n;
+  if (snap->map) munmap(snap->map, snap->map_size);
+
+  snap->first_block = first_block;
+  snap->brk = sbrk(0);
+  snap->heap_size = first_block ? snap->brk - (char *)first_block : 0;
+  snap->num_slots = num_live;
+  snap->map_size = snap->heap_size + num_live * sizeof(SavedSlot);
+  snap->map = map_zeroed(snap->map_size ? snap->map_size : 1);
+
+  memcpy(snap->map, first_block, snap->heap_size);
+  SavedSlot * saved = (SavedSlot *)((char *)snap->map + snap->heap_size);
+  for (uint32_t i = 0; i < num_live; ++i)
+  {
+    AllocInfo * ai = slots + live[i];
+    saved[i] = (SavedSlot){live[i], ai->ptr, ai->sz};
+  }
+}
+
+static void do_restore (Arg * args)
+{
+  // Puts the heap and slots back how they were at snapshot <id>.
+  // restore <id>
+  NEED_BLOCKS();
+  ASSERT2(args[0].n < MAX_SNAPSHOTS, "Bad snapshot number");
+  Snapshot * snap = snapshots + args[0].n;
+  if (!snap->map)
+  {
+    print("No snapshot "); printdec(args[0].n); print(".\n");
+    exit(1);
+  }
+
+  sbrk(snap->brk - (char *)sbrk(0));
+  note_brk();
+  first_block = snap->first_block;
+  memcpy(first_block, snap->map, snap->heap_size);
+
+  while (num_live) setslot(live[num_live - 1], NULL, 0);
+  SavedSlot * saved = (SavedSlot *)((char *)snap->map + snap->heap_size);
+  for (uint32_t i = 0; i < snap->num_slots; ++i)
+  {
+    setslot(saved[i].slot, saved[i].ptr, saved[i].sz);
+  }
+}
+
 static void showslot (int i)
 {
   print("slot num:");
@@ -115,66 +610,128 @@ static void showslot (int i)
   printhex32(slots[i].sz);
 }
 
-static void do_showslot (char ** args)
+static void do_showslot (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
+  uint32_t slot = args[0].n;
   showslot((int)slot);
   nl();
 }
 
-static void do_showslots (char ** args)
+static void do_showslots (Arg * args)
 {
   if (verbose) print("-- slots --\n");
-  for (int i = 0; i < sizeof(slots)/sizeof(slots[0]); ++i)
+  sort_live();
+  for (uint32_t i = 0; i < num_live; ++i)
   {
-    if (!slots[i].ptr && !slots[i].sz) continue;
-    showslot(i);
+    showslot(live[i]);
     nl();
   }
 }
 
-static int enable_check = 1;
+static void do_slots (Arg * args)
+{
+  // Sets how many slots there are (initially 256).  Slots in use must fit.
+  // slots <count>
+  set_capacity(args[0].n);
+}
+
+// How slot contents are filled and checked.  Bytes is the original byte at
+// a time loop.  Words fills with memset() and checks a word at a time.
+// Sampled fills the same way but only checks the first and last few bytes
+// (next to the headers, where overruns show up) and one word in every
+// SAMPLE_STRIDE bytes in between.  Whichever is used, a mismatch is
+// reported at the exact byte, the same as always.
+#define CHECK_OFF 0
+#define CHECK_BYTES 1
+#define CHECK_WORDS 2
+#define CHECK_SAMPLED 3
+
+#define SAMPLE_EDGE 32
+#define SAMPLE_STRIDE 256
+
+static int check_mode = CHECK_BYTES;
 
-static void do_checks (char ** args)
+static void do_checks (Arg * args)
 {
-  // Turn checks on or off
-  // checks <0 or 1>
-  enable_check = atoi(args[0]) != 0;
+  // Turn checks off, or on with the given mode
+  // checks <0=off, 1=bytes, 2=words or 3=sampled>
+  ASSERT2(args[0].n <= CHECK_SAMPLED, "Bad check mode");
+  check_mode = args[0].n;
 }
 
-static void do_rel (char ** args)
+static void do_rel (Arg * args)
 {
   // Turns printing of relative addresses on
   // rel <0 for absolute addresses, 1 for relative addresses>
-  relative_addrs = atoi(args[0]) != 0;
+  relative_addrs = args[0].n != 0;
 }
 
-static void do_v (char ** args)
+static void do_v (Arg * args)
 {
   // Turns on and off verbose mode
-  verbose = atoi(args[0]) != 0;
+  verbose = args[0].n != 0;
+}
+
+// Returns the first of the sz bytes at d which isn't chk, or NULL.
+static uint8_t * find_bad_bytes (uint8_t * d, size_t sz, uint8_t chk)
+{
+  for (size_t i = 0; i < sz; ++i)
+  {
+    if (d[i] != chk) return d + i;
+  }
+  return NULL;
+}
+
+// Like find_bad_bytes(), but compares a word at a time where it can.
+static uint8_t * find_bad_words (uint8_t * d, size_t sz, uint8_t chk)
+{
+  uint8_t * end = d + sz;
+  while (d < end && ((uintptr_t)d % sizeof(uintptr_t)))
+  {
+    if (*d != chk) return d;
+    ++d;
+  }
+  uintptr_t pattern = (uintptr_t)-1 / 0xff * chk;
+  for (; d + sizeof(uintptr_t) <= end; d += sizeof(uintptr_t))
+  {
+    if (*(uintptr_t *)d != pattern) return find_bad_bytes(d, sizeof(uintptr_t), chk);
+  }
+  return find_bad_bytes(d, end - d, chk);
+}
+
+static uint8_t * find_bad_sampled (uint8_t * d, size_t sz, uint8_t chk)
+{
+  if (sz <= 2 * SAMPLE_EDGE + SAMPLE_STRIDE) return find_bad_words(d, sz, chk);
+  uint8_t * bad = find_bad_words(d, SAMPLE_EDGE, chk);
+  if (bad) return bad;
+  for (size_t i = SAMPLE_EDGE; i + SAMPLE_EDGE + sizeof(uintptr_t) <= sz; i += SAMPLE_STRIDE)
+  {
+    bad = find_bad_words(d + i, sizeof(uintptr_t), chk);
+    if (bad) return bad;
+  }
+  return find_bad_words(d + sz - SAMPLE_EDGE, SAMPLE_EDGE, chk);
 }
 
 static void check2 (void * data, size_t sz, uint8_t chk, int force, const char * prefix)
 {
-  if (!enable_check && !force) return;
+  if (check_mode == CHECK_OFF && !force) return;
   //dumpaddr(data);sp();printhex32(sz);sp();printhex32(chk);nl();
-  uint8_t * d = data;
-  for (int i = 0; i < sz; ++i)
+  uint8_t * d;
+  if (check_mode == CHECK_BYTES) d = find_bad_bytes(data, sz, chk);
+  else if (check_mode == CHECK_SAMPLED && !force) d = find_bad_sampled(data, sz, chk);
+  else d = find_bad_words(data, sz, chk);
+  if (d)
   {
-    if (d[i] != chk)
-    {
-      if (prefix) print(prefix); else print("** ");
-      print("Bad check value at ");
-      dumpaddr((d+i));
-      print(" (real 0x");
-      printhex(d[i], 2);
-      print(" != expected 0x");
-      printhex(chk, 2);
-      print(")");
-      nl();
-      exit(1);
-    }
+    if (prefix) print(prefix); else print("** ");
+    print("Bad check value at ");
+    dumpaddr(d);
+    print(" (real 0x");
+    printhex(*d, 2);
+    print(" != expected 0x");
+    printhex(chk, 2);
+    print(")");
+    nl();
+    exit(1);
   }
 }
 
@@ -186,8 +743,13 @@ static void check (void * data, size_t sz)
 
 static void fillcheck (void * data, size_t sz, int offset)
 {
-  if (!enable_check) return;
+  if (check_mode == CHECK_OFF) return;
   uint8_t chk = hash(data, sz, offset);
+  if (check_mode != CHECK_BYTES)
+  {
+    memset(data, chk, sz);
+    return;
+  }
   uint8_t * d = data;
   for (int i = 0; i < sz; ++i)
   {
@@ -195,64 +757,227 @@ static void fillcheck (void * data, size_t sz, int offset)
   }
 }
 
-static void do_malloc (char ** args)
+// ---------------------------------------------------------------------------
+//  Recording
+// ---------------------------------------------------------------------------
+
+// While recording, each call the slot operations make into the heap is
+// appended to a trace file as a fixed-size binary record, which replay can
+// run again later.  The file is written through an mmap()ed window, so
+// recording a call is just filling in a record; the window moves along (and
+// the file grows) every REC_WINDOW records.  The first record's worth of the
+// file is a header, which is filled in when recording stops (including when
+// tester crashes).  Calls made by the threads command aren't recorded.  A
+// calloc() is recorded with its total size, and replayed as calloc(1, size).
+//
+// Timestamps are in CPU cycles where there's a cycle counter, and the header
+// gives how many there were per second while recording.
+
+typedef struct
+{
+  char magic[4]; // "HTRC"
+  uint32_t version; // 1
+  uint64_t count; // Number of records following
+  uint64_t ticks_per_sec; // For the timestamps
+} TraceHeader;
+
+typedef struct
+{
+  uint64_t ticks; // Timestamp
+  uint32_t op; // T_MALLOC, T_FREE, T_REALLOC or T_CALLOC
+  uint32_t slot;
+  uint32_t size; // Requested size (0 for free)
+  uint32_t offset; // Of the result (or for free, the argument) from first_block
+} Record;
+
+_Static_assert(sizeof(TraceHeader) == sizeof(Record), "Header is one record");
+
+#define NO_OFFSET 0xffffffffu // For NULL
+#define REC_WINDOW 65536 // Records; keeps windows a multiple of the page size
+
+static int rec_fd = -1;
+static Record * rec_window;
+static uint64_t rec_base; // Index in the file of rec_window[0]
+static uint64_t rec_count;
+static uint64_t rec_start_ticks;
+static uint64_t rec_start_ns;
+
+static uint64_t ticks ()
+{
+#if defined(__i386__) || defined(__x86_64__)
+  return __builtin_ia32_rdtsc();
+#else
+  return now_ns();
+#endif
+}
+
+static uint32_t heap_offset (void * ptr)
+{
+  if (!ptr) return NO_OFFSET;
+  return (char *)ptr - (char *)first_block;
+}
+
+// Maps the window holding record number i (counting the header as 0).
+static void record_window (uint64_t i)
+{
+  if (rec_window) munmap(rec_window, REC_WINDOW * sizeof(Record));
+  rec_base = i - i % REC_WINDOW;
+  off_t end = (rec_base + REC_WINDOW) * sizeof(Record);
+  ASSERT2(0 == ftruncate(rec_fd, end), "Couldn't grow trace file");
+  rec_window = mmap(NULL, REC_WINDOW * sizeof(Record), PROT_READ | PROT_WRITE,
+                    MAP_SHARED, rec_fd, rec_base * sizeof(Record));
+  ASSERT2(rec_window != MAP_FAILED, "Couldn't map trace file");
+}
+
+static void record_event (int op, uint32_t slot, size_t size, void * ptr)
+{
+  if (rec_fd < 0) return;
+  uint64_t i = rec_count + 1;
+  if (i - rec_base >= REC_WINDOW) record_window(i);
+  Record * r = rec_window + (i - rec_base);
+  r->ticks = ticks();
+  r->op = op;
+  r->slot = slot;
+  r->size = size;
+  r->offset = heap_offset(ptr);
+  rec_count++;
+}
+
+// Finishes off the trace file, if there is one.  Only makes system calls,
+// so it's also safe when we've crashed.
+static void record_stop ()
+{
+  if (rec_fd < 0) return;
+  uint64_t ns = now_ns() - rec_start_ns;
+  uint64_t t = ticks() - rec_start_ticks;
+  TraceHeader h = {"HTRC", 1, rec_count, 1000000000u};
+  if (ns) h.ticks_per_sec = (double)t * 1e9 / ns;
+  munmap(rec_window, REC_WINDOW * sizeof(Record));
+  rec_window = NULL;
+  ASSERT2(0 == ftruncate(rec_fd, (rec_count + 1) * sizeof(Record)),
+          "Couldn't truncate trace file");
+  lseek(rec_fd, 0, SEEK_SET);
+  write_all(rec_fd, &h, sizeof(h));
+  close(rec_fd);
+  rec_fd = -1;
+}
+
+static void do_record (Arg * args)
+{
+  // Starts recording heap calls to a trace file, or stops with "off".
+  // record <path or off>
+  record_stop();
+  if (0 == strcmp(args[0].s, "off")) return;
+  rec_fd = open(args[0].s, O_RDWR | O_CREAT | O_TRUNC, 0666);
+  if (rec_fd < 0)
+  {
+    print("Couldn't open "); print(args[0].s); nl();
+    exit(1);
+  }
+  rec_count = 0;
+  record_window(1);
+  rec_start_ticks = ticks();
+  rec_start_ns = now_ns();
+}
+
+static void mallocslot (uint32_t slot, size_t size)
 {
-  uint32_t slot = struint32(args[0]);
-  uint32_t size = struint32(args[1]);
-  slots[slot].ptr = MALLOC(size);
-  slots[slot].sz = size;
-  fillcheck(slots[slot].ptr, size, 0);
+  void * mem;
+  TIMED(T_MALLOC, mem = MALLOC(size));
+  record_event(T_MALLOC, slot, size, mem);
+  note_brk();
+  setslot(slot, mem, size);
+  fillcheck(mem, size, 0);
 }
 
-static void freeslot (uint32_t slot)
+static void do_malloc (Arg * args)
+{
+  uint32_t slot = args[0].n;
+  uint32_t size = args[1].n;
+  mallocslot(slot, size);
+}
+
+static void callocslot (uint32_t slot, size_t nmemb, size_t size)
+{
+  void * mem;
+  TIMED(T_CALLOC, mem = CALLOC(nmemb, size));
+  size_t sz = mem ? nmemb * size : 0;
+  record_event(T_CALLOC, slot, nmemb * size, mem);
+  note_brk();
+  setslot(slot, mem, sz);
+  fillcheck(mem, sz, 0);
+}
+
+static void do_calloc (Arg * args)
+{
+  // calloc <slot> <nmemb> <size>
+  uint32_t slot = args[0].n;
+  callocslot(slot, args[1].n, args[2].n);
+}
+
+// Checks and frees the slot's memory, but leaves the slot alone.
+static void freemem (uint32_t slot)
 {
   void * mem = slots[slot].ptr;
   size_t sz = slots[slot].sz;
   if (mem) check(mem, sz);
-  FREE(mem);
-  slots[slot].ptr = NULL;
-  slots[slot].sz = 0;
+  TIMED(T_FREE, FREE(mem));
+  record_event(T_FREE, slot, 0, mem);
 }
 
-static void do_free (char ** args)
+static void freeslot (uint32_t slot)
+{
+  freemem(slot);
+  setslot(slot, NULL, 0);
+}
+
+static void do_free (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
+  uint32_t slot = args[0].n;
   freeslot(slot);
 }
 
-static void do_doublefree (char ** args)
+static void do_doublefree (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
+  uint32_t slot = args[0].n;
   AllocInfo ai = slots[slot];
   do_free(args);
-  slots[slot] = ai;
+  setslot(slot, ai.ptr, ai.sz);
   do_free(args);
 }
 
-static void do_freeall (char ** args)
+static void do_freeall (Arg * args)
 {
-  for (uint32_t i = 0; i < sizeof(slots)/sizeof(slots[0]); ++i)
+  // Frees in slot order.  The slots are emptied as we go, but live[] is
+  // left alone until the end so it stays in order.
+  sort_live();
+  for (uint32_t i = 0; i < num_live; ++i)
   {
-    if (!slots[i].ptr && !slots[i].sz) continue;
-    freeslot(i);
+    uint32_t slot = live[i];
+    freemem(slot);
+    slots[slot].ptr = NULL;
+    slots[slot].sz = 0;
+    slots[slot].live = 0;
   }
+  num_live = 0;
 }
 
-static void do_realloc (char ** args)
+static void reallocslot (uint32_t slot, size_t size)
 {
-  uint32_t slot = struint32(args[0]);
-  uint32_t size = struint32(args[1]);
   uint8_t chk = hash(slots[slot].ptr, slots[slot].sz, 0);
-  slots[slot].ptr = REALLOC(slots[slot].ptr, size);
-  if (slots[slot].ptr)
+  void * mem;
+  TIMED(T_REALLOC, mem = REALLOC(slots[slot].ptr, size));
+  record_event(T_REALLOC, slot, size, mem);
+  note_brk();
+  if (mem)
   {
     // Check that old data was copied
     size_t sz = slots[slot].sz;
     if (sz > size) sz = size;
-    check2(slots[slot].ptr, sz, chk, 0, "** realloc step 1: ");
+    check2(mem, sz, chk, 0, "** realloc step 1: ");
 
-    slots[slot].sz = size;
-    fillcheck(slots[slot].ptr, size, 0);
+    setslot(slot, mem, size);
+    fillcheck(mem, size, 0);
   }
   else
   {
@@ -261,39 +986,45 @@ static void do_realloc (char ** args)
   }
 }
 
-static void do_killslot (char ** args)
+static void do_realloc (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
-  slots[slot].ptr = NULL;
-  slots[slot].sz = 0;
+  uint32_t slot = args[0].n;
+  uint32_t size = args[1].n;
+  reallocslot(slot, size);
 }
 
-static void do_poke (char ** args)
+static void do_killslot (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
-  uint32_t offset = struint32(args[1]);
-  uint8_t value = (uint8_t)struint32(args[2]);
+  uint32_t slot = args[0].n;
+  setslot(slot, NULL, 0);
+}
+
+static void do_poke (Arg * args)
+{
+  uint32_t slot = args[0].n;
+  uint32_t offset = args[1].n;
+  uint8_t value = (uint8_t)args[2].n;
 
   uint8_t * m = slots[slot].ptr;
   m += offset;
   *m = value;
 }
 
-static void do_pokes (char ** args)
+static void do_pokes (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
-  uint32_t offset = struint32(args[1]);
+  uint32_t slot = args[0].n;
+  uint32_t offset = args[1].n;
   char * m = slots[slot].ptr;
   m += offset;
-  strcpy(m, args[2]);
+  strcpy(m, args[2].s);
 }
 
-static void do_fillslot (char ** args)
+static void do_fillslot (Arg * args)
 {
   // fillslot <slot> <offset> <byte value to fill with or -1 for automatic>
-  uint32_t slot = struint32(args[0]);
-  uint32_t offset = struint32(args[1]);
-  int byte = (int)struint32(args[2]);
+  uint32_t slot = args[0].n;
+  uint32_t offset = args[1].n;
+  int byte = (int)args[2].n;
   if (byte == -1) byte = hash(slots[slot].ptr, slots[slot].sz, 0);
 
   char * m = slots[slot].ptr;
@@ -301,19 +1032,19 @@ static void do_fillslot (char ** args)
   memset(m, byte & 0xff, slots[slot].sz - offset);
 }
 
-static void do_checkslot (char ** args)
+static void do_checkslot (Arg * args)
 {
   // checkslot <slot> <byte value to check or -1 for automatic>
-  uint32_t slot = struint32(args[0]);
-  int byte = (int)struint32(args[1]);
+  uint32_t slot = args[0].n;
+  int byte = (int)args[1].n;
   if (byte == -1) byte = hash(slots[slot].ptr, slots[slot].sz, 0);
   check2(slots[slot].ptr, slots[slot].sz, byte & 0xff, 1, NULL);
 }
 
-static void do_peeks (char ** args)
+static void do_peeks (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
-  uint32_t offset = struint32(args[1]);
+  uint32_t slot = args[0].n;
+  uint32_t offset = args[1].n;
   char * m = slots[slot].ptr;
   m += offset;
   print("peeks slot+off:");
@@ -327,11 +1058,11 @@ static void do_peeks (char ** args)
   nl();
 }
 
-static void do_peek (char ** args)
+static void do_peek (Arg * args)
 {
   // Peek one byte
-  uint32_t slot = struint32(args[0]);
-  uint32_t offset = struint32(args[1]);
+  uint32_t slot = args[0].n;
+  uint32_t offset = args[1].n;
   uint8_t * m = slots[slot].ptr;
   m += offset;
   print("peek ");
@@ -362,11 +1093,12 @@ static void hexdump (void * ptr, size_t sz, char * prefix)
   nl();
 }
 
-static void do_dumpslot (char ** args)
+static void do_dumpslot (Arg * args)
 {
   // Do a hexdump of a slot
   // dumpslot <slot>
-  uint32_t slot = struint32(args[0]);
+  NEED_BLOCKS();
+  uint32_t slot = args[0].n;
   if (verbose)
   {
     print("-- ");
@@ -385,12 +1117,13 @@ static void do_dumpslot (char ** args)
   if (sz) hexdump(m + sizeof(Block) + slots[slot].sz, sz, "X ");
 }
 
-static void do_blocktoslot (char ** args)
+static void do_blocktoslot (Arg * args)
 {
   // Makes a slot that corresponds to a block
   // blocktoslot <block number> <slot>
-  uint32_t block = struint32(args[0]);
-  uint32_t slot = struint32(args[1]);
+  NEED_BLOCKS();
+  uint32_t block = args[0].n;
+  uint32_t slot = args[1].n;
 
   Block * b = (Block *)first_block;
   for (uint32_t i = 0; i < block; ++i)
@@ -398,14 +1131,13 @@ static void do_blocktoslot (char ** args)
     ASSERT2(b->size, "Hit sentinel before finding block");
     b = (Block *)(((char *)b)+b->size);
   }
-  slots[slot].ptr = (b + 1);
-  slots[slot].sz = b->size - sizeof(Block);
+  setslot(slot, b + 1, b->size - sizeof(Block));
 }
 
-static void do_peek32 (char ** args)
+static void do_peek32 (Arg * args)
 {
-  uint32_t slot = struint32(args[0]);
-  int32_t offset = (int32_t)struint32(args[1]);
+  uint32_t slot = args[0].n;
+  int32_t offset = (int32_t)args[1].n;
   char * m = slots[slot].ptr;
   m += offset;
   print("peek32 slot+off:");
@@ -420,54 +1152,1029 @@ static void do_peek32 (char ** args)
 }
 
 
+static void do_replay (Arg * args)
+{
+  // Runs the calls in a trace file made by record through the slots again,
+  // either as fast as possible (<timing> 0) or spaced out as they were when
+  // recorded (<timing> 1).  Then prints a "replay key=value ..." line,
+  // including how many results came out somewhere other than they did
+  // when recorded.
+  // replay <path> <timing>
+  int fd = open(args[0].s, O_RDONLY);
+  struct stat st;
+  TraceHeader * h = MAP_FAILED;
+  if (fd >= 0 && 0 == fstat(fd, &st) && st.st_size >= sizeof(TraceHeader))
+  {
+    h = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  }
+  if (fd >= 0) close(fd);
+  bool ok = h != MAP_FAILED && !memcmp(h->magic, "HTRC", 4) &&
+            h->version == 1 && (h->count + 1) * sizeof(Record) <= st.st_size;
+  Record * records = (Record *)(h + 1);
+  uint32_t max_slot = 0;
+  for (uint64_t i = 0; ok && i < h->count; ++i)
+  {
+    if (records[i].slot > max_slot) max_slot = records[i].slot;
+  }
+  if (!ok || max_slot == UINT32_MAX)
+  {
+    print("Not a trace file: "); print(args[0].s); nl();
+    exit(1);
+  }
+  // The trace may have been recorded with more slots than there are now
+  if (max_slot >= num_slots) set_capacity(max_slot + 1);
+
+  uint64_t moved = 0;
+  uint64_t start = now_ns();
+  for (uint64_t i = 0; i < h->count; ++i)
+  {
+    Record * r = records + i;
+    if (args[1].n)
+    {
+      uint64_t due = start + (double)(r->ticks - records[0].ticks) * 1e9
+                     / h->ticks_per_sec;
+      uint64_t t;
+      while ((t = now_ns()) < due)
+      {
+        if (due - t < 1000000) continue; // Spin for the last millisecond
+        struct timespec ts = {0, due - t - 1000000};
+        nanosleep(&ts, NULL);
+      }
+    }
 
-#define CMD(name, count)                                                   \
-  if (0 == strcmp(#name, argv[i])) {                                       \
-    if (remaining < count) {                                               \
-      print("Bad number of arguments for '"); print(#name); print("'.\n"); \
-      return 1;                                                            \
-    }                                                                      \
-    do_ ## name(argv + i + 1);                                             \
-    i += count;                                                            \
-    continue;                                                              \
+    void * ptr = slots[r->slot].ptr;
+    if (r->op == T_MALLOC) mallocslot(r->slot, r->size);
+    else if (r->op == T_FREE) freeslot(r->slot);
+    else if (r->op == T_REALLOC) reallocslot(r->slot, r->size);
+    else if (r->op == T_CALLOC) callocslot(r->slot, 1, r->size);
+    else ASSERT2(false, "Bad trace record");
+    if (r->op != T_FREE) ptr = slots[r->slot].ptr;
+    if (heap_offset(ptr) != r->offset) moved++;
   }
+  uint64_t wall_ns = now_ns() - start;
+
+  print("replay");
+  print_kv("count", h->count);
+  print_kv("wall_ns", wall_ns);
+  print_kv("moved", moved);
+  nl();
+  munmap(h, st.st_size);
+}
 
+// ---------------------------------------------------------------------------
+//  Workloads
+// ---------------------------------------------------------------------------
 
-int main (int argc, char * argv[])
+// Synthetic workloads, generated on the fly from a seed so that runs are
+// reproducible without trace files.  They work through the normal slot
+// operations, so checks and bench timing apply as usual, and leave whatever
+// is still allocated in the slots when they finish.
+
+static uint64_t rng_state;
+
+// xorshift64*, on whichever state is given (threads each have their own).
+static uint32_t xorshift (uint64_t * state)
 {
-  int remaining = argc - 1;
-  for (int i = 1; i < argc; ++i, --remaining)
-  {
-    if (0 == strcmp(argv[i], "--")) continue;
-    CMD(sbrk, 1);
-    CMD(showbrk, 0);
-    CMD(alignbrk, 0);
-    CMD(showslot, 1);
-    CMD(showslots, 0);
-    CMD(malloc, 2);
-    CMD(realloc, 2);
-    CMD(free, 1);
-    CMD(doublefree, 1);
-    CMD(freeall, 0);
-    CMD(killslot, 1);
-    CMD(poke, 3);
-    CMD(pokes, 3);
-    CMD(peeks, 2);
-    CMD(peek, 2);
-    CMD(peek32, 2);
-    CMD(fillslot, 3);
-    CMD(checkslot, 2);
-    CMD(checksentinel, 0);
-    CMD(dumpslot, 1);
-    CMD(blocktoslot, 2);
-    CMD(mark, 0);
-    CMD(showheap, 0);
-    CMD(checks, 1);
-    CMD(rel, 1);
-    CMD(v, 1);
-    print("Command not found: ");print(argv[i]);nl();
-    exit(1);
+  *state ^= *state >> 12;
+  *state ^= *state << 25;
+  *state ^= *state >> 27;
+  return (*state * 2685821657736338717ull) >> 32;
+}
+
+static uint64_t seed_rng (uint32_t seed)
+{
+  return seed * 0x9E3779B97F4A7C15ull + 1;
+}
+
+static uint32_t rng ()
+{
+  return xorshift(&rng_state);
+}
+
+// Uniform in [lo, hi].  The span is worked out in 64 bits, since it's 2^32
+// for the whole range.
+static uint32_t rng_range (uint32_t lo, uint32_t hi)
+{
+  return lo + (uint32_t)(rng() % ((uint64_t)hi - lo + 1));
+}
+
+// Roughly power-law: each doubling of size is half as likely.
+static uint32_t rng_powerlaw (uint32_t max)
+{
+  int k = __builtin_ctz(rng() | 0x80000000u);
+  uint32_t lo = 1u << k;
+  if (lo > max) return max;
+  uint32_t hi = (lo << 1) - 1;
+  if (hi > max) hi = max;
+  return rng_range(lo, hi);
+}
+
+static bool slot_used (uint32_t slot)
+{
+  return slots[slot].live != 0;
+}
+
+static void churn (uint32_t ops, uint32_t n, uint32_t max, bool powerlaw)
+{
+  // Random slot each time: allocate it if it's empty, else free it.
+  for (uint32_t i = 0; i < ops; ++i)
+  {
+    uint32_t slot = rng_range(0, n - 1);
+    if (slot_used(slot)) freeslot(slot);
+    else mallocslot(slot, powerlaw ? rng_powerlaw(max) : rng_range(0, max));
+  }
+}
+
+static void lifo (uint32_t ops, uint32_t n, uint32_t max)
+{
+  // Slots 0..depth-1 form a stack; push or pop at random.
+  uint32_t depth = 0;
+  while (depth < n && slot_used(depth)) ++depth;
+  for (uint32_t i = 0; i < ops; ++i)
+  {
+    bool push = depth == 0 || (depth < n && (rng() & 1));
+    if (push) mallocslot(depth++, rng_range(0, max));
+    else freeslot(--depth);
+  }
+}
+
+static void fifo (uint32_t ops, uint32_t n, uint32_t max, bool bursts)
+{
+  // Slots form a ring queue; allocate at the tail and free from the head.
+  // With bursts, allocations and frees come in runs (producer/consumer).
+  uint32_t head = 0, len = 0;
+  while (len < n && slot_used(len)) ++len;
+  uint32_t run = 0;
+  bool produce = true;
+  for (uint32_t i = 0; i < ops; ++i)
+  {
+    if (bursts)
+    {
+      if (run == 0)
+      {
+        produce = !produce;
+        run = rng_range(1, n / 4 + 1);
+      }
+      --run;
+    }
+    else
+    {
+      produce = rng() & 1;
+    }
+    if (len == 0) produce = true;
+    if (len == n) produce = false;
+
+    if (produce) mallocslot((head + len++) % n, rng_range(0, max));
+    else { freeslot(head); head = (head + 1) % n; --len; }
+  }
+}
+
+static void realloc_growth (uint32_t ops, uint32_t n, uint32_t max)
+{
+  // Random slot each time: start it small, grow it by about half with
+  // realloc(), and free it once it reaches max.
+  for (uint32_t i = 0; i < ops; ++i)
+  {
+    uint32_t slot = rng_range(0, n - 1);
+    size_t sz = slots[slot].sz;
+    if (!slot_used(slot)) mallocslot(slot, rng_range(1, 16));
+    else if (sz >= max) freeslot(slot);
+    else
+    {
+      sz += sz / 2 + rng_range(1, 16);
+      if (sz > max) sz = max;
+      reallocslot(slot, sz);
+    }
+  }
+}
+
+static void do_workload (Arg * args)
+{
+  // Runs a generated workload of <ops> operations over slots 0..<slots>-1
+  // with sizes up to <maxsize>.  Kinds are churn, powerlaw, lifo, fifo,
+  // prodcons and realloc.
+  // workload <kind> <ops> <slots> <maxsize> <seed>
+  const char * kind = args[0].s;
+  uint32_t ops = args[1].n;
+  uint32_t n = args[2].n;
+  uint32_t max = args[3].n;
+  rng_state = seed_rng(args[4].n);
+
+  ASSERT2(n > 0 && n <= num_slots, "Bad slot count");
+  if (0 == strcmp(kind, "churn")) churn(ops, n, max, false);
+  else if (0 == strcmp(kind, "powerlaw")) churn(ops, n, max, true);
+  else if (0 == strcmp(kind, "lifo")) lifo(ops, n, max);
+  else if (0 == strcmp(kind, "fifo")) fifo(ops, n, max, false);
+  else if (0 == strcmp(kind, "prodcons")) fifo(ops, n, max, true);
+  else if (0 == strcmp(kind, "realloc")) realloc_growth(ops, n, max);
+  else
+  {
+    print("Unknown workload: "); print(kind); nl();
+    exit(1);
+  }
+}
+
+
+
+// ---------------------------------------------------------------------------
+//  Threads
+// ---------------------------------------------------------------------------
+
+// The threads command runs a seeded malloc/free/realloc mix in several
+// threads at once to see how the heap copes with contention.  The heap
+// isn't thread safe, so this only works in the tester-mt build, where
+// heaplock.c wraps it in a global lock (and counts how long each thread
+// spends waiting for it).  Each thread has its own handful of slots and
+// latency histograms rather than using the slot table, and the main thread
+// only looks at them once it has joined all the threads, so the threads
+// don't share anything but the heap.  They don't print either; the output
+// buffer isn't thread safe.
+
+#ifdef HEAP_LOCK
+
+#define MAX_THREADS 64
+#define THREAD_SLOTS 64
+
+// From heaplock.c
+extern __thread uint64_t heap_lock_wait_ns;
+extern __thread uint64_t heap_lock_waits;
+
+typedef struct
+{
+  pthread_t thread;
+  uint32_t id;
+  uint32_t ops;
+  uint32_t max;
+  uint64_t rng_state;
+  void * ptrs[THREAD_SLOTS];
+  size_t sizes[THREAD_SLOTS];
+  Latency latency[T_COUNT];
+  uint64_t wall_ns;
+  uint64_t lock_wait_ns;
+  uint64_t lock_waits;
+  uint64_t bad; // Blocks whose contents changed while this thread had them
+} Worker;
+
+// Each thread fills its blocks with its own byte and checks the first and
+// last of them before letting go, which is enough to notice another thread
+// being handed the same memory.
+static void worker_check (Worker * w, int slot, uint8_t fill)
+{
+  uint8_t * p = w->ptrs[slot];
+  size_t sz = w->sizes[slot];
+  if (sz && (p[0] != fill || p[sz - 1] != fill)) w->bad++;
+}
+
+static void * worker_main (void * arg)
+{
+  Worker * w = arg;
+  uint8_t fill = 0x80 | w->id;
+  uint64_t start = now_ns();
+  for (uint32_t i = 0; i < w->ops; ++i)
+  {
+    uint32_t r = xorshift(&w->rng_state);
+    int slot = r % THREAD_SLOTS;
+    size_t sz = 1 + xorshift(&w->rng_state) % w->max;
+    void * p = w->ptrs[slot];
+    int op;
+    uint64_t t0;
+
+    if (p) worker_check(w, slot, fill);
+
+    // Empty slots get allocated; full ones are freed or (a quarter of the
+    // time) resized.
+    if (!p)
+    {
+      op = T_MALLOC;
+      t0 = now_ns();
+      p = MALLOC(sz);
+    }
+    else if ((r >> 16) % 4 == 0)
+    {
+      op = T_REALLOC;
+      t0 = now_ns();
+      p = REALLOC(p, sz);
+    }
+    else
+    {
+      op = T_FREE;
+      t0 = now_ns();
+      FREE(p);
+      p = NULL;
+    }
+    hist_add(w->latency + op, now_ns() - t0);
+
+    if (!p) sz = 0;
+    else memset(p, fill, sz);
+    w->ptrs[slot] = p;
+    w->sizes[slot] = sz;
+  }
+
+  // Clean up outside of the timing.
+  w->wall_ns = now_ns() - start;
+  for (int slot = 0; slot < THREAD_SLOTS; ++slot)
+  {
+    if (!w->ptrs[slot]) continue;
+    worker_check(w, slot, fill);
+    FREE(w->ptrs[slot]);
+    w->ptrs[slot] = NULL;
+  }
+
+  w->lock_wait_ns = heap_lock_wait_ns;
+  w->lock_waits = heap_lock_waits;
+  return NULL;
+}
+
+static void do_threads (Arg * args)
+{
+  // Runs <ops> operations with sizes up to <maxsize> in each of <n> threads
+  // at once.  Prints a "thread key=value ..." line per thread and a
+  // "threads key=value ..." line with the totals.  Inside a bench block, the
+  // calls are counted in its report too.
+  // threads <n> <ops> <maxsize> <seed>
+  uint32_t n = args[0].n;
+  uint32_t ops = args[1].n;
+  uint32_t max = args[2].n;
+  uint32_t seed = args[3].n;
+  ASSERT2(n > 0 && n <= MAX_THREADS, "Bad thread count");
+  ASSERT2(max > 0, "Bad max size");
+
+  Worker * workers = map_zeroed(n * sizeof(Worker));
+  uint64_t start = now_ns();
+  for (uint32_t t = 0; t < n; ++t)
+  {
+    Worker * w = workers + t;
+    w->id = t;
+    w->ops = ops;
+    w->max = max;
+    w->rng_state = seed_rng(seed + t);
+    ASSERT2(0 == pthread_create(&w->thread, NULL, worker_main, w),
+            "Couldn't start thread");
+  }
+  for (uint32_t t = 0; t < n; ++t) pthread_join(workers[t].thread, NULL);
+  uint64_t wall_ns = now_ns() - start;
+  note_brk();
+
+  uint64_t total_ops = 0, lock_wait_ns = 0, lock_waits = 0, bad = 0;
+  for (uint32_t t = 0; t < n; ++t)
+  {
+    Worker * w = workers + t;
+    Latency all = {0};
+    for (int op = 0; op < T_COUNT; ++op)
+    {
+      hist_merge(&all, w->latency + op);
+      if (timing) hist_merge(latency + op, w->latency + op);
+    }
+    total_ops += all.count;
+    lock_wait_ns += w->lock_wait_ns;
+    lock_waits += w->lock_waits;
+    bad += w->bad;
+
+    print("thread");
+    print_kv("id", t);
+    print_kv("ops", all.count);
+    print_kv("wall_ns", w->wall_ns);
+    print_kv("ops_per_sec", w->wall_ns ? all.count * 1000000000u / w->wall_ns : 0);
+    print_kv("p50_ns", percentile(&all, 500));
+    print_kv("p99_ns", percentile(&all, 990));
+    print_kv("max_ns", all.max_ns);
+    print_kv("lock_waits", w->lock_waits);
+    print_kv("lock_wait_ns", w->lock_wait_ns);
+    nl();
+  }
+  print("threads");
+  print_kv("count", n);
+  print_kv("ops", total_ops);
+  print_kv("wall_ns", wall_ns);
+  print_kv("ops_per_sec", wall_ns ? total_ops * 1000000000u / wall_ns : 0);
+  print_kv("lock_waits", lock_waits);
+  print_kv("lock_wait_ns", lock_wait_ns);
+  nl();
+  munmap(workers, n * sizeof(Worker));
+
+  if (bad)
+  {
+    printdec(bad); print(" blocks were changed by another thread"); nl();
+    exit(1);
+  }
+}
+
+#else
+
+static void do_threads (Arg * args)
+{
+  // threads <n> <ops> <maxsize> <seed>
+  print("This build isn't thread safe; use tester-mt for threads.\n");
+  exit(1);
+}
+
+#endif
+
+// ---------------------------------------------------------------------------
+//  Scenarios
+// ---------------------------------------------------------------------------
+
+// Several independent scenarios can be run in one process, each starting
+// with "scenario <id>".  That puts the heap, the slots and the settings back
+// the way they were when tester started, and prints "== scenario <id>".  A
+// scenario that finishes (rather than exiting or crashing) is followed by
+// "== end <id>", so the output can be split back up.  Neither a command's
+// arguments nor a block can carry on into the next scenario.
+//
+// A bad command (one that doesn't compile) only ends its own scenario: the
+// rest of it is skipped, its end marker gives the return code it would
+// have exited with ("== end <id> <rc>"), and the next scenario runs as
+// usual.  tester then exits with that code once everything has run.
+
+static bool in_scenario = false;
+static uint32_t scenario_id;
+static int scenario_rc; // Nonzero once the current scenario has failed
+static int exit_rc; // What tester exits with when it gets to the end
+
+static void end_scenario ()
+{
+  if (!in_scenario) return;
+  print("== end "); printdec(scenario_id);
+  if (scenario_rc) { sp(); printdec(scenario_rc); }
+  nl();
+  in_scenario = false;
+  scenario_rc = 0;
+}
+
+// Exits with rc, or inside a scenario, just fails the scenario.
+static void fail_scenario (int rc)
+{
+  if (!in_scenario) exit(rc);
+  scenario_rc = exit_rc = rc;
+}
+
+static void do_scenario (Arg * args)
+{
+  // scenario <id>
+  NEED_BLOCKS();
+  end_scenario();
+
+  while (num_live) setslot(live[num_live - 1], NULL, 0);
+  if (num_slots != DEFAULT_SLOTS) set_capacity(DEFAULT_SLOTS);
+  for (int i = 0; i < MAX_SNAPSHOTS; ++i)
+  {
+    if (snapshots[i].map) munmap(snapshots[i].map, snapshots[i].map_size);
+    snapshots[i].map = NULL;
+  }
+  record_stop();
+
+  // Lowering the break gives back whole pages, which come back zeroed, but
+  // the rest of the page initial_brk is in keeps the old heap's bytes.
+  // Clear those, so the scenario starts with zeroed memory like a new
+  // process would.
+  char * brk = sbrk(0);
+  uintptr_t page = sysconf(_SC_PAGESIZE);
+  char * page_end = (char *)(((uintptr_t)initial_brk + page - 1) & ~(page - 1));
+  memset(initial_brk, 0, (brk < page_end ? brk : page_end) - initial_brk);
+  sbrk(initial_brk - brk);
+  peak_brk = initial_brk;
+  first_block = NULL;
+
+  relative_addrs = 0;
+  verbose = 1;
+  check_mode = CHECK_BYTES;
+
+  scenario_id = args[0].n;
+  in_scenario = true;
+  print("== scenario "); printdec(scenario_id); nl();
+}
+
+
+static void do_script (Arg * args);
+
+// ---------------------------------------------------------------------------
+//  Commands
+// ---------------------------------------------------------------------------
+
+// Commands are compiled into an array of Insns before they run, so words are
+// looked up and numbers converted once, and running them is just a loop over
+// a table of handlers.  A command's argument types are given as a string with
+// one character per argument: 'n' for a number, 'i' for a plain decimal
+// number (read with atoi(), as the on/off settings always have been), 's'
+// for a string, and 'r' for a slot number which may also be given as an
+// inclusive range "lo..hi", in which case the command is run once for each
+// slot in it.
+//
+// Block commands run the commands between them and a matching "end".  They
+// are compiled with the length of their body as an extra argument after
+// their own, and their handler is given the body to run.  A command with a
+// slot range is compiled as an internal range block around it.
+
+#define MAX_ARGS 5
+#define MAX_DEPTH 16
+
+typedef struct Insn Insn;
+
+typedef struct
+{
+  const char * name;
+  const char * argtypes;
+  void (*fn) (Arg * args);
+  void (*block) (Arg * args, Insn * body, Insn * end);
+} Command;
+
+struct Insn
+{
+  uint8_t op; // Index into commands[]
+  Arg args[MAX_ARGS];
+};
+
+static void run_code (Insn * i, Insn * end);
+
+static void block_bench (Arg * args, Insn * body, Insn * end)
+{
+  // Runs the block <reps> times, timing each malloc, free and realloc, and
+  // then prints throughput and latency percentiles for each.
+  // bench <reps> ... end
+  memset(latency, 0, sizeof(latency));
+  timing = true;
+  uint64_t start = now_ns();
+  for (uint32_t r = 0; r < args[0].n; ++r) run_code(body, end);
+  uint64_t wall_ns = now_ns() - start;
+  timing = false;
+  report_latency(wall_ns);
+}
+
+static void block_repeat (Arg * args, Insn * body, Insn * end)
+{
+  // Runs the block <count> times.
+  // repeat <count> ... end
+  for (uint32_t r = 0; r < args[0].n; ++r) run_code(body, end);
+}
+
+static void block_range (Arg * args, Insn * body, Insn * end)
+{
+  // Runs the single command in the block once for each slot from args[1] to
+  // args[2], putting the slot in its argument number args[0].
+  Arg * slot = body->args + args[0].n;
+  for (uint64_t s = args[1].n; s <= args[2].n; ++s)
+  {
+    slot->n = s;
+    run_code(body, end);
+  }
+}
+
+static void op_notfound (Arg * args)
+{
+  print("Command not found: ");print(args[0].s);nl();
+  fail_scenario(1);
+}
+
+static void op_badargs (Arg * args)
+{
+  print("Bad number of arguments for '"); print(args[0].s); print("'.\n");
+  fail_scenario(1);
+}
+
+static void op_error (Arg * args)
+{
+  println(args[0].s);
+  fail_scenario(1);
+}
+
+#define CMD(name, argtypes) { #name, argtypes, do_ ## name, NULL }
+#define BLOCK(name, argtypes) { #name, argtypes, NULL, block_ ## name }
+
+static Command commands[] =
+{
+  // These first few are internal and don't have names; compiling bad input
+  // produces them so that errors happen in order with everything else.
+  {NULL, "s", op_notfound, NULL},
+  {NULL, "s", op_badargs, NULL},
+  {NULL, "s", op_error, NULL},
+  {NULL, "nnn", NULL, block_range},
+
+  CMD(sbrk, "n"),
+  CMD(showbrk, ""),
+  CMD(alignbrk, ""),
+  CMD(showslot, "r"),
+  CMD(showslots, ""),
+  CMD(slots, "n"),
+  CMD(malloc, "rn"),
+  CMD(realloc, "rn"),
+  CMD(calloc, "rnn"),
+  CMD(free, "r"),
+  CMD(doublefree, "r"),
+  CMD(freeall, ""),
+  CMD(killslot, "r"),
+  CMD(poke, "rnn"),
+  CMD(pokes, "rns"),
+  CMD(peeks, "rn"),
+  CMD(peek, "rn"),
+  CMD(peek32, "rn"),
+  CMD(fillslot, "rnn"),
+  CMD(checkslot, "rn"),
+  CMD(checksentinel, ""),
+  CMD(dumpslot, "r"),
+  CMD(blocktoslot, "nn"),
+  CMD(mark, ""),
+  CMD(showheap, ""),
+  CMD(dumpheap, "s"),
+  CMD(fragreport, ""),
+  CMD(memstats, ""),
+  CMD(snapshot, "n"),
+  CMD(restore, "n"),
+  CMD(checks, "i"),
+  CMD(rel, "i"),
+  CMD(v, "i"),
+  CMD(script, "s"),
+  CMD(workload, "snnnn"),
+  CMD(threads, "nnnn"),
+  CMD(record, "s"),
+  CMD(replay, "sn"),
+  CMD(scenario, "n"),
+  BLOCK(bench, "n"),
+  BLOCK(repeat, "n"),
+};
+
+#define OP_NOTFOUND 0
+#define OP_BADARGS 1
+#define OP_ERROR 2
+#define OP_RANGE 3
+#define NUM_COMMANDS (sizeof(commands)/sizeof(commands[0]))
+
+// Open-addressed hash table from command name to index in commands[] (plus
+// one, so that zero means empty).
+#define CMD_HASH_SIZE 128
+static uint8_t cmd_hash[CMD_HASH_SIZE];
+
+static uint32_t hash_name (const char * s)
+{
+  // FNV-1a
+  uint32_t h = 2166136261u;
+  while (*s) { h ^= (uint8_t)*s++; h *= 16777619u; }
+  return h;
+}
+
+static void init_commands ()
+{
+  for (int i = 0; i < NUM_COMMANDS; ++i)
+  {
+    if (!commands[i].name) continue;
+    uint32_t h = hash_name(commands[i].name);
+    while (cmd_hash[h % CMD_HASH_SIZE]) ++h;
+    cmd_hash[h % CMD_HASH_SIZE] = i + 1;
+  }
+}
+
+// Returns the index of the named command, or -1.
+static int find_command (const char * name)
+{
+  for (uint32_t h = hash_name(name); cmd_hash[h % CMD_HASH_SIZE]; ++h)
+  {
+    int i = cmd_hash[h % CMD_HASH_SIZE] - 1;
+    if (0 == strcmp(commands[i].name, name)) return i;
+  }
+  return -1;
+}
+
+
+// ---------------------------------------------------------------------------
+//  Programs
+// ---------------------------------------------------------------------------
+
+// A compiled chunk of commands.  These are mmap()ed so they don't come from
+// either heap.  Input that doesn't fit is compiled and run a chunk at a time.
+
+#define CODE_MAX 65536
+#define STRINGS_MAX 65536
+#define WORD_MAX 256
+
+typedef struct
+{
+  int len;
+  bool stop; // Last instruction is an error; run what we have
+  int depth; // Number of blocks still waiting for an "end"
+  int blocks[MAX_DEPTH]; // Where those blocks start
+  size_t strings_len;
+  char strings[STRINGS_MAX]; // Copies of string arguments, if needed
+  Insn code[CODE_MAX];
+} Program;
+
+static Program * program_new ()
+{
+  Program * p = mmap(NULL, sizeof(Program), PROT_READ | PROT_WRITE,
+                     MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  ASSERT2(p != MAP_FAILED, "Couldn't map program");
+  p->len = 0;
+  p->stop = false;
+  p->depth = 0;
+  p->strings_len = 0;
+  return p;
+}
+
+static void program_delete (Program * p)
+{
+  munmap(p, sizeof(Program));
+}
+
+// True if there may not be room to compile one more command (which takes
+// two Insns if it has a slot range).
+static bool program_full (Program * p)
+{
+  if (p->stop) return true;
+  if (p->len >= CODE_MAX - 1) return true;
+  return p->strings_len + MAX_ARGS * WORD_MAX > STRINGS_MAX;
+}
+
+static void run_code (Insn * i, Insn * end)
+{
+  for (; i < end; ++i)
+  {
+    Command * c = commands + i->op;
+    // A failed scenario is skipped up until the next one
+    bool skip = scenario_rc && c->fn != do_scenario;
+    if (!c->block)
+    {
+      if (!skip) c->fn(i->args);
+      continue;
+    }
+    int len = i->args[strlen(c->argtypes)].n;
+    if (!skip) c->block(i->args, i + 1, i + 1 + len);
+    i += len;
+  }
+}
+
+// Adds an instruction that fails with an error (of type op, with argument
+// arg) and stops compiling.  A block that's still open can't be run, so the
+// error replaces it.
+static int compile_error (Program * p, int op, const char * arg)
+{
+  if (p->depth) p->len = p->blocks[0];
+  p->depth = 0;
+  Insn * insn = p->code + p->len++;
+  insn->op = op;
+  insn->args[0].s = arg;
+  p->stop = true;
+  return 1;
+}
+
+// Runs what has been compiled so far and empties p.  Blocks can't be split
+// across chunks, so this waits until they're closed unless we're finishing.
+static void run_program (Program * p, bool finish)
+{
+  if (p->depth && !finish && !p->stop) return;
+  if (p->depth) compile_error(p, OP_ERROR, "Missing 'end' for block.");
+  run_code(p->code, p->code + p->len);
+  p->len = 0;
+  p->stop = false;
+  p->strings_len = 0;
+}
+
+static const char * program_string (Program * p, const char * s, bool copy)
+{
+  if (!copy) return s;
+  char * r = p->strings + p->strings_len;
+  size_t n = strlen(s) + 1;
+  memcpy(r, s, n);
+  p->strings_len += n;
+  return r;
+}
+
+// Parses a slot range "lo..hi" into lo and hi.  Returns false if it's bad.
+static bool parse_range (const char * w, uint32_t * lo, uint32_t * hi)
+{
+  char first[32];
+  const char * dots = strstr(w, "..");
+  size_t n = dots - w;
+  if (n == 0 || n >= sizeof(first) || !dots[2]) return false;
+  memcpy(first, w, n);
+  first[n] = 0;
+  *lo = struint32(first);
+  *hi = struint32((char *)dots + 2);
+  return *lo <= *hi;
+}
+
+// Compiles the command in words[0] onto the end of p.  remaining is the
+// number of words available starting with the command itself.  If copy is
+// set, string arguments are copied into p since the words won't last.
+// Returns the number of words consumed.
+static int compile (Program * p, char ** words, int remaining, bool copy)
+{
+  if (0 == strcmp(words[0], "--")) return 1;
+
+  if (p->depth && program_full(p))
+  {
+    return compile_error(p, OP_ERROR, "Block too long.");
+  }
+
+  if (0 == strcmp(words[0], "scenario") && p->depth)
+  {
+    // The error closes the block; "scenario" is compiled again next time,
+    // so the next scenario still starts
+    compile_error(p, OP_ERROR, "Missing 'end' for block.");
+    return 0;
+  }
+
+  if (0 == strcmp(words[0], "end"))
+  {
+    if (!p->depth) return compile_error(p, OP_ERROR, "'end' without a block.");
+    Insn * b = p->code + p->blocks[--p->depth];
+    b->args[strlen(commands[b->op].argtypes)].n = p->len - (b - p->code) - 1;
+    return 1;
+  }
+
+  int op = find_command(words[0]);
+  if (op == -1)
+  {
+    return compile_error(p, OP_NOTFOUND, program_string(p, words[0], copy));
+  }
+
+  const char * types = commands[op].argtypes;
+  int count = strlen(types);
+  for (int i = 1; i < remaining && i <= count; ++i)
+  {
+    // Arguments stop at the start of the next scenario
+    if (0 == strcmp(words[i], "scenario")) remaining = i;
+  }
+  if (remaining <= count)
+  {
+    return compile_error(p, OP_BADARGS, commands[op].name);
+  }
+
+  if (commands[op].block && p->depth == MAX_DEPTH)
+  {
+    return compile_error(p, OP_ERROR, "Blocks nested too deeply.");
+  }
+
+  Arg args[MAX_ARGS];
+  int range = -1;
+  uint32_t lo, hi;
+  for (int i = 0; i < count; ++i)
+  {
+    char * w = words[1 + i];
+    if (types[i] == 's') args[i].s = program_string(p, w, copy);
+    else if (types[i] == 'r' && strstr(w, ".."))
+    {
+      if (range != -1)
+      {
+        return compile_error(p, OP_ERROR, "Only one slot range per command.");
+      }
+      if (!parse_range(w, &lo, &hi))
+      {
+        return compile_error(p, OP_ERROR, "Bad slot range.");
+      }
+      range = i;
+      args[i].n = lo;
+    }
+    else if (types[i] == 'i') args[i].n = atoi(w);
+    else args[i].n = struint32(w);
+  }
+
+  if (range != -1)
+  {
+    Insn * r = p->code + p->len++;
+    r->op = OP_RANGE;
+    r->args[0].n = range;
+    r->args[1].n = lo;
+    r->args[2].n = hi;
+    r->args[3].n = 1; // Body length
+  }
+
+  Insn * insn = p->code + p->len++;
+  insn->op = op;
+  memcpy(insn->args, args, count * sizeof(Arg));
+
+  if (commands[op].block) p->blocks[p->depth++] = insn - p->code;
+  return count + 1;
+}
+
+
+// ---------------------------------------------------------------------------
+//  Scripts
+// ---------------------------------------------------------------------------
+
+// Commands can also be read from a file or stdin, which avoids argv length
+// limits for long traces.  The input is read through a fixed buffer and
+// split into a small window of words (enough for the longest command), so
+// memory use is the same however long the script is, and none of it comes
+// from the heap under test.  A word starting with # comments out the rest
+// of the line.
+
+#define WINDOW (MAX_ARGS + 1)
+
+typedef struct
+{
+  int fd;
+  size_t pos;
+  size_t len;
+  char buf[65536];
+} Reader;
+
+static int reader_getc (Reader * r)
+{
+  if (r->pos == r->len)
+  {
+    ssize_t n = read(r->fd, r->buf, sizeof(r->buf));
+    if (n <= 0) return -1;
+    r->pos = 0;
+    r->len = n;
+  }
+  return (uint8_t)r->buf[r->pos++];
+}
+
+// Reads the next word into out.  Returns 0 at end of input.
+static int reader_word (Reader * r, char * out)
+{
+  int c;
+  while (true)
+  {
+    do c = reader_getc(r); while (c == ' ' || c == '\t' || c == '\n' || c == '\r');
+    if (c != '#') break;
+    do c = reader_getc(r); while (c != '\n' && c != -1);
+  }
+  if (c == -1) return 0;
+
+  int n = 0;
+  while (c != -1 && c != ' ' && c != '\t' && c != '\n' && c != '\r')
+  {
+    if (n == WORD_MAX - 1)
+    {
+      print("Word too long in script.\n");
+      exit(1);
+    }
+    out[n++] = c;
+    c = reader_getc(r);
+  }
+  out[n] = 0;
+  return 1;
+}
+
+static void do_script (Arg * args)
+{
+  // Runs commands from a file, or from stdin if the path is "-"
+  // script <path>
+  Reader r;
+  r.pos = r.len = 0;
+  r.fd = 0;
+  if (strcmp(args[0].s, "-")) r.fd = open(args[0].s, O_RDONLY);
+  if (r.fd < 0)
+  {
+    print("Can't open script: "); print(args[0].s); nl();
+    exit(1);
+  }
+
+  // The window is a ring of word buffers; words is rebuilt from it for each
+  // command and NULL-terminated just like the real argv.
+  Program * p = program_new();
+  char window[WINDOW][WORD_MAX];
+  char * words[WINDOW + 1];
+  int head = 0, n = 0;
+  while (true)
+  {
+    while (n < WINDOW && reader_word(&r, window[(head + n) % WINDOW])) ++n;
+    if (n == 0) break;
+    for (int i = 0; i < n; ++i) words[i] = window[(head + i) % WINDOW];
+    words[n] = NULL;
+    int used = compile(p, words, n, true);
+    if (used > n) used = n;
+    head = (head + used) % WINDOW;
+    n -= used;
+    if (program_full(p)) run_program(p, false);
+  }
+  run_program(p, true);
+  program_delete(p);
+
+  if (r.fd != 0) close(r.fd);
+}
+
+
+static void crashed (int sig)
+{
+  // Don't lose buffered output or the trace being recorded when the heap
+  // under test crashes us.
+  flush();
+  record_stop();
+  signal(sig, SIG_DFL);
+  raise(sig);
+}
+
+
+int main (int argc, char * argv[])
+{
+  atexit(flush);
+  atexit(record_stop);
+  signal(SIGSEGV, crashed);
+  signal(SIGBUS, crashed);
+  signal(SIGFPE, crashed);
+  signal(SIGABRT, crashed);
+  initial_brk = peak_brk = sbrk(0);
+  init_commands();
+  set_capacity(DEFAULT_SLOTS);
+
+  Program * p = program_new();
+  for (int i = 1; i < argc;)
+  {
+    i += compile(p, argv + i, argc - i, false);
+    if (program_full(p)) run_program(p, false);
   }
+  run_program(p, true);
+  end_scenario();
 
-  return 0;
+  return exit_rc;
 }
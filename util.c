@@ -7,39 +7,87 @@
 #include <unistd.h>
 #include "util.h"
 
+// Output is collected in a static buffer and written out in large pieces
+// instead of with a write() per call.  It's written out after a newline once
+// the buffer is half full, when it would otherwise overflow, when flush() is
+// called, and before a failed assertion exits.  Programs should arrange for
+// flush() to be called at exit too.
+static char outbuf[8192];
+static size_t outlen = 0;
+
+void flush ()
+{
+  size_t done = 0;
+  while (done < outlen)
+  {
+    ssize_t n = write(2, outbuf + done, outlen - done);
+    if (n <= 0) break;
+    done += n;
+  }
+  outlen = 0;
+}
+
+static void out (const char * s, size_t n)
+{
+  if (outlen + n > sizeof(outbuf))
+  {
+    flush();
+    if (n > sizeof(outbuf))
+    {
+      write(2, s, n);
+      return;
+    }
+  }
+  memcpy(outbuf + outlen, s, n);
+  outlen += n;
+}
+
 void printhex (uint32_t x, int chars)
 {
   static char * cc = "0123456789abcdef";
-  char out[8] = "00000000";
-  char * o = out + 7;
+  char buf[8] = "00000000";
+  char * o = buf + 7;
   for (int i = 0; i < chars; ++i)
   {
     *o = cc[x & 0xf];
     x >>= 4;
     --o;
   }
-  write(2, out + (8-chars), chars);
+  out(buf + (8-chars), chars);
+}
+
+void printdec (uint64_t x)
+{
+  char buf[20];
+  char * o = buf + sizeof(buf);
+  do
+  {
+    *--o = '0' + (x % 10);
+    x /= 10;
+  } while (x);
+  out(o, buf + sizeof(buf) - o);
 }
 
 void printhex32 (uint32_t x)
 {
-  write(2, "0x", 2);
+  out("0x", 2);
   printhex(x, 8);
 }
 
 void nl ()
 {
-  write(2, "\n", 1);
+  out("\n", 1);
+  if (outlen >= sizeof(outbuf) / 2) flush();
 }
 
 void sp ()
 {
-  write(2, " ", 1);
+  out(" ", 1);
 }
 
 void print (const char * s)
 {
-  write(2, s, strlen(s));
+  out(s, strlen(s));
 }
 
 void println (const char * s)
@@ -64,6 +112,7 @@ void _x_assert (int c, Str s, Str f, Str l, Str d)
       print(d);
     }
     nl();
+    flush();
     exit(1);
   }
 }
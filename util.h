@@ -14,10 +14,12 @@ typedef const char * Str;
 
 void printhex (uint32_t x, int chars); // print hex
 void printhex32 (uint32_t x); // Print 0x1234beef
+void printdec (uint64_t x); // Print decimal
 void nl (); // Print newline
 void sp (); // Print space
 void print (const char * s);
 void println (const char * s);
+void flush (); // Write out buffered output
 
 uint32_t struint32 (char * str);
 